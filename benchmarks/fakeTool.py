@@ -0,0 +1,83 @@
+# This python script is a (hermetic) stand-in for the external tools
+# (podman, cekit, openssl and ssh-keygen) used by cpb. It is installed
+# (by benchmarks/federation.py) on the PATH under each tool's name.
+#
+# Each call is recorded (as one JSON line) in the file named by the
+# CPB_FAKE_LOG environment variable, and then sleeps for the number of
+# seconds given by the CPB_FAKE_SLEEP_<TOOL> environment variable (for
+# example CPB_FAKE_SLEEP_SSH_KEYGEN).
+#
+# The openssl and ssh-keygen stand-ins create (dummy) output files so that
+# cpb's later steps find the files they expect.
+
+import json
+import os
+import sys
+import time
+
+def touchFile(filePath, contents) :
+  with open(filePath, 'w') as aFile :
+    aFile.write(contents)
+
+def argsAfter(someArgs, aFlag) :
+  return [
+    someArgs[anIndex+1] for anIndex, anArg in enumerate(someArgs[:-1])
+      if anArg == aFlag
+  ]
+
+def fakeOpenssl(someArgs) :
+  for aFlag in [ '-out', '-keyout' ] :
+    for aPath in argsAfter(someArgs, aFlag) :
+      touchFile(aPath, "-----BEGIN FAKE-----\n-----END FAKE-----\n")
+  return 0
+
+def fakeSshKeygen(someArgs) :
+  comment = ([ 'fake' ] + argsAfter(someArgs, '-C'))[-1]
+  for aPath in argsAfter(someArgs, '-f') :
+    touchFile(aPath, "-----BEGIN FAKE-----\n-----END FAKE-----\n")
+    touchFile(aPath + '.pub', "ssh-fake AAAAfake {}\n".format(comment))
+  return 0
+
+def fakePodman(someArgs) :
+  # no images exist (so every image is (re)built)
+  if someArgs[:2] == [ 'image', 'inspect' ] :
+    return 1
+  return 0
+
+fakeTools = {
+  'openssl'    : fakeOpenssl,
+  'ssh-keygen' : fakeSshKeygen,
+  'podman'     : fakePodman,
+}
+
+def fakeTool(toolName, someArgs) :
+  startTime = time.time()
+  sleepTime = float(os.environ.get(
+    'CPB_FAKE_SLEEP_' + toolName.upper().replace('-', '_'), '0'
+  ))
+  if 0 < sleepTime :
+    time.sleep(sleepTime)
+
+  returnCode = 0
+  if toolName in fakeTools :
+    returnCode = fakeTools[toolName](someArgs)
+
+  logPath = os.environ.get('CPB_FAKE_LOG', None)
+  if logPath :
+    logLine = json.dumps({
+      'tool'       : toolName,
+      'args'       : someArgs,
+      'start'      : startTime,
+      'duration'   : time.time() - startTime,
+      'returnCode' : returnCode,
+    }) + "\n"
+    # a single (appended) write so that concurrent calls do not interleave
+    logFd = os.open(logPath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try :
+      os.write(logFd, logLine.encode())
+    finally :
+      os.close(logFd)
+  return returnCode
+
+if __name__ == '__main__' :
+  sys.exit(fakeTool(sys.argv[1], sys.argv[2:]))
@@ -0,0 +1,301 @@
+# This python script benchmarks cpb against synthetic compute pod
+# federations, using a hermetic (fake) toolchain (see
+# benchmarks/fakeTool.py) in place of podman, cekit, openssl and
+# ssh-keygen.
+#
+# For each combination of the number of pods/users (`--pods`) and the
+# number of cekit image descriptions (`--images`) a synthetic federation
+# (cpf.yaml, config.yaml and cekit modules) is generated in a scratch
+# directory, and each of the cpb `--commands` is run (in order) against
+# it.
+#
+# For each command the wall time, the peak RSS (of cpb and its child
+# processes), and the number of (and time spent in) the calls to each of
+# the fake tools are recorded. The results are written as JSON (to
+# `--output`) so that runs can be compared over time.
+#
+# Typical use:
+#
+#   python benchmarks/federation.py --pods 10 --pods 100 --images 5 \
+#     --output federation.json
+
+import click
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+benchmarksDir = os.path.dirname(os.path.abspath(__file__))
+
+fakeToolNames = [ 'podman', 'cekit', 'openssl', 'ssh-keygen' ]
+
+defaultSleeps = {
+  'podman'     : 0.01,
+  'cekit'      : 0.2,
+  'openssl'    : 0.01,
+  'ssh-keygen' : 0.01,
+}
+
+############################################################################
+# Synthetic federations
+
+def writeYaml(filePath, someData) :
+  with open(filePath, 'w') as yamlFile :
+    yaml.safe_dump(someData, yamlFile, default_flow_style=False, sort_keys=False)
+
+def installFakeTools(binDir) :
+  os.makedirs(binDir, exist_ok=True)
+  for aToolName in fakeToolNames :
+    toolPath = os.path.join(binDir, aToolName)
+    with open(toolPath, 'w') as toolFile :
+      toolFile.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(
+        sys.executable, os.path.join(benchmarksDir, 'fakeTool.py'), aToolName
+      ))
+    os.chmod(toolPath, 0o755)
+
+# Each synthetic image installs its own module, which (like most real
+# modules) installs a shared common module.
+#
+def createModules(modulesDir, numImages) :
+  moduleNames = [ 'benchCommon' ] + [
+    'benchModule{:04d}'.format(anImageNum) for anImageNum in range(numImages)
+  ]
+  for aModuleName in moduleNames :
+    aModuleDir = os.path.join(modulesDir, aModuleName)
+    os.makedirs(aModuleDir, exist_ok=True)
+    aModule = {
+      'name'        : aModuleName,
+      'version'     : 1.0,
+      'description' : "A synthetic benchmark module",
+      'execute'     : [ { 'script' : 'install.sh' } ],
+    }
+    if aModuleName != 'benchCommon' :
+      aModule['modules'] = { 'install' : [ { 'name' : 'benchCommon' } ] }
+    writeYaml(os.path.join(aModuleDir, 'module.yaml'), aModule)
+    with open(os.path.join(aModuleDir, 'install.sh'), 'w') as installFile :
+      installFile.write("#!/bin/sh\necho installing {}\n".format(aModuleName))
+  return moduleNames[1:]
+
+def createFederation(workDir, numPods, numImages) :
+  modulesDir = os.path.join(workDir, 'cekitModules')
+  moduleNames = createModules(modulesDir, numImages)
+
+  imageNames = [ 'bench{:04d}'.format(anImageNum) for anImageNum in range(numImages) ]
+  imageDescs = {
+    'defaults' : { 'repositories' : [ modulesDir ] },
+  }
+  for anImageName, aModuleName in zip(imageNames, moduleNames) :
+    imageDescs[anImageName] = {
+      'basedOn'         : 'python:slim',
+      'packagesManager' : 'apt-get',
+      'description'     : "A synthetic benchmark image",
+      'version'         : 1.0,
+      'modules'         : [ aModuleName ],
+    }
+
+  cpf = {
+    'federationName' : 'bench',
+    'keyType'        : 'rsa',
+    'keySize'        : 2048,
+    'cryptoBackend'  : 'openssl',
+    'certificateAuthority' : {
+      'organization' : 'Benchmarks',
+      'country'      : 'UK',
+      'province'     : 'Nowhere',
+      'locality'     : 'Nowhere',
+      'commonName'   : 'bench CA',
+    },
+    'podDefaults' : { 'images' : imageNames[:1] },
+    'natsServer'  : { 'host' : 'nats01' },
+    # (images are never pushed, since the benchmark answers "no" to push)
+    'registry'    : { 'host' : 'registry.invalid', 'port' : 5000, 'isSecure' : False },
+    'computePods' : [
+      {
+        'host'   : 'host{:04d}'.format(aPodNum),
+        'images' : [ imageNames[aPodNum % numImages] ],
+      } for aPodNum in range(numPods)
+    ],
+    'users' : [
+      { 'name' : 'user{:04d}@example.com'.format(aUserNum) }
+        for aUserNum in range(numPods)
+    ],
+    'cekitImageDescriptions' : imageDescs,
+  }
+  writeYaml(os.path.join(workDir, 'cpf.yaml'), cpf)
+
+  writeYaml(os.path.join(workDir, 'config.yaml'), {
+    'buildBaseDir'            : os.path.join(workDir, 'buildBase'),
+    'certificateAuthorityDir' : 'certAuthority',
+    'podsDir'                 : 'pods',
+    'usersDir'                : 'users',
+  })
+
+############################################################################
+# Running cpb
+
+def loadToolCalls(logPath) :
+  toolCalls = []
+  try :
+    with open(logPath) as logFile :
+      for aLine in logFile :
+        toolCalls.append(json.loads(aLine))
+  except IOError :
+    pass
+  return toolCalls
+
+def summarizeToolCalls(toolCalls) :
+  toolSummary = {}
+  for aCall in toolCalls :
+    aSummary = toolSummary.setdefault(aCall['tool'], {
+      'calls' : 0, 'seconds' : 0.0, 'failures' : 0
+    })
+    aSummary['calls']   += 1
+    aSummary['seconds'] += aCall['duration']
+    if aCall['returnCode'] != 0 :
+      aSummary['failures'] += 1
+  for aSummary in toolSummary.values() :
+    aSummary['seconds'] = round(aSummary['seconds'], 3)
+  return toolSummary
+
+def runCpb(workDir, binDir, cpbCommand, sleeps, logDir, runNum) :
+  toolLog = os.path.join(logDir, '{:02d}-{}.calls'.format(runNum, cpbCommand))
+  outLog  = os.path.join(logDir, '{:02d}-{}.log'.format(runNum, cpbCommand))
+
+  env = dict(os.environ)
+  env['PATH'] = os.pathsep.join([ binDir, env.get('PATH', '') ])
+  env['PYTHONPATH'] = os.pathsep.join(
+    [ repoDir ] + [ aPath for aPath in [ env.get('PYTHONPATH', '') ] if aPath ]
+  )
+  env['CPB_FAKE_LOG'] = toolLog
+  for aToolName, aSleep in sleeps.items() :
+    env['CPB_FAKE_SLEEP_' + aToolName.upper().replace('-', '_')] = str(aSleep)
+
+  cmd = [
+    sys.executable, '-c', 'import cpb; cpb.cli()',
+    '--config', os.path.join(workDir, 'global-config.yaml'), cpbCommand
+  ]
+  startTime = time.time()
+  with open(outLog, 'w') as outFile :
+    proc = subprocess.Popen(cmd, cwd=workDir, env=env,
+      stdin=subprocess.PIPE, stdout=outFile, stderr=subprocess.STDOUT)
+    # answer "no" to any prompts (for example build's push/overwrite)
+    proc.stdin.write(b"n\n" * 10)
+    proc.stdin.close()
+    _, waitStatus, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(waitStatus)
+  wallTime = time.time() - startTime
+
+  toolCalls = loadToolCalls(toolLog)
+  return {
+    'command'      : cpbCommand,
+    'returnCode'   : proc.returncode,
+    'wallSeconds'  : round(wallTime, 3),
+    'userSeconds'  : round(rusage.ru_utime, 3),
+    'sysSeconds'   : round(rusage.ru_stime, 3),
+    # ru_maxrss is in KiB on Linux (but bytes on macOS)
+    'peakRssKiB'   : rusage.ru_maxrss if sys.platform != 'darwin' else rusage.ru_maxrss // 1024,
+    'subprocesses' : len(toolCalls),
+    'tools'        : summarizeToolCalls(toolCalls),
+    'log'          : outLog,
+  }
+
+def runScenario(numPods, numImages, cpbCommands, sleeps, baseDir) :
+  workDir = os.path.join(baseDir, 'pods{}-images{}'.format(numPods, numImages))
+  shutil.rmtree(workDir, ignore_errors=True)
+  os.makedirs(workDir)
+  binDir = os.path.join(workDir, 'fakeBin')
+  logDir = os.path.join(workDir, 'logs')
+  os.makedirs(logDir)
+  installFakeTools(binDir)
+
+  startTime = time.time()
+  createFederation(workDir, numPods, numImages)
+  generateTime = time.time() - startTime
+
+  phases = []
+  for runNum, cpbCommand in enumerate(cpbCommands) :
+    aPhase = runCpb(workDir, binDir, cpbCommand, sleeps, logDir, runNum)
+    click.echo("  {:8} {:>9.3f}s rc={:<4} {:>6} calls {:>8} KiB".format(
+      cpbCommand, aPhase['wallSeconds'], aPhase['returnCode'],
+      aPhase['subprocesses'], aPhase['peakRssKiB']
+    ))
+    phases.append(aPhase)
+
+  return {
+    'pods'            : numPods,
+    'users'           : numPods,
+    'images'          : numImages,
+    'workDir'         : workDir,
+    'generateSeconds' : round(generateTime, 3),
+    'wallSeconds'     : round(sum(aPhase['wallSeconds'] for aPhase in phases), 3),
+    'subprocesses'    : sum(aPhase['subprocesses'] for aPhase in phases),
+    'peakRssKiB'      : max([ aPhase['peakRssKiB'] for aPhase in phases ] + [ 0 ]),
+    'phases'          : phases,
+  }
+
+def parseSleeps(someSleeps) :
+  sleeps = dict(defaultSleeps)
+  for aSleep in someSleeps :
+    aToolName, _, seconds = aSleep.partition('=')
+    if aToolName not in fakeToolNames :
+      raise click.BadParameter("unknown tool [{}]".format(aToolName))
+    sleeps[aToolName] = float(seconds)
+  return sleeps
+
+@click.command()
+@click.option("-p", "--pods", multiple=True, type=int, default=[ 10, 100, 1000 ],
+  show_default=True, help="The number of pods (and users) in a federation.")
+@click.option("-i", "--images", multiple=True, type=int, default=[ 5, 50 ],
+  show_default=True, help="The number of cekit image descriptions in a federation.")
+@click.option("-c", "--commands", "cpbCommands", multiple=True,
+  default=[ 'create', 'build', 'images', 'pods', 'users' ],
+  show_default=True, help="The cpb commands to run (in order).")
+@click.option("-s", "--sleep", "someSleeps", multiple=True,
+  help="The time (TOOL=SECONDS) each call to a fake tool takes.")
+@click.option("-w", "--work-dir", "workDir", default=None,
+  help="The directory in which to create the federations (default: a temporary directory).")
+@click.option("-k", "--keep", default=False, is_flag=True,
+  help="Keep the (temporary) federations.")
+@click.option("-o", "--output", default=None,
+  help="Write the (JSON) results to this file.")
+def federation(pods, images, cpbCommands, someSleeps, workDir, keep, output) :
+  """
+  benchmarks cpb against synthetic compute pod federations.
+  """
+  sleeps = parseSleeps(someSleeps)
+  baseDir = workDir
+  if baseDir is None :
+    baseDir = tempfile.mkdtemp(prefix='cpbBench-')
+  baseDir = os.path.abspath(baseDir)
+
+  results = {
+    'python'    : sys.version,
+    'started'   : time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'sleeps'    : sleeps,
+    'commands'  : list(cpbCommands),
+    'scenarios' : [],
+  }
+  try :
+    for numPods in pods :
+      for numImages in images :
+        click.echo("{} pods/users, {} images".format(numPods, numImages))
+        results['scenarios'].append(
+          runScenario(numPods, numImages, cpbCommands, sleeps, baseDir)
+        )
+  finally :
+    if not keep and workDir is None :
+      shutil.rmtree(baseDir, ignore_errors=True)
+
+  if output is not None :
+    with open(output, 'w') as outputFile :
+      json.dump(results, outputFile, indent=2)
+  else :
+    click.echo(json.dumps(results, indent=2))
+
+if __name__ == '__main__' :
+  federation()
@@ -0,0 +1,163 @@
+# This python script records the import time of the cpb entry point
+# (using `python -X importtime`) so that regressions in the cpb startup
+# time can be found.
+#
+# Each scenario is run `--repeat` times and the median of the total
+# (cumulative) import time is reported, together with the slowest
+# imports and any "heavy" modules which were (unexpectedly) imported.
+#
+# The results are written (as JSON) to `--output`. If a `--baseline`
+# (the JSON results of an earlier run) is given, any scenario which is
+# more than `--threshold` times slower than the baseline is reported, and
+# the script exits with a non-zero status.
+#
+# Typical use:
+#
+#   python benchmarks/importTime.py --output importTime.json
+#   python benchmarks/importTime.py --baseline importTime.json
+
+import click
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+scenarios = {
+  'import'     : "import cpb",
+  'help'       : "import cpb; cpb.cli(['--help'])",
+  'buildHelp'  : "import cpb; cpb.cli(['build', '--help'])",
+  'createHelp' : "import cpb; cpb.cli(['create', '--help'])",
+}
+
+# Modules which should only be imported by the subcommands which use them
+heavyModules = [
+  'cpb.build', 'cpb.create', 'cpb.configCache', 'cpb.templates',
+  'jinja2', 'pymakeself', 'yaml', 'cryptography',
+]
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Parse the `-X importtime` lines:
+#   import time: self [us] | cumulative | imported package
+#
+def parseImportTimes(stderr) :
+  importTimes = {}
+  for aLine in stderr.splitlines() :
+    if not aLine.startswith('import time:') : continue
+    fields = aLine[len('import time:'):].split('|')
+    if len(fields) != 3 : continue
+    try :
+      selfTime   = int(fields[0].strip())
+      cumulative = int(fields[1].strip())
+    except ValueError :
+      continue
+    moduleName = fields[2].strip()
+    importTimes[moduleName] = {
+      'self'       : selfTime,
+      'cumulative' : cumulative,
+      'topLevel'   : not fields[2].startswith('  ')
+    }
+  return importTimes
+
+def runScenario(pythonCode) :
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(
+    [ repoDir ] + [ aPath for aPath in [ env.get('PYTHONPATH', '') ] if aPath ]
+  )
+  result = subprocess.run(
+    [ sys.executable, '-X', 'importtime', '-c', pythonCode ],
+    env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+  )
+  importTimes = parseImportTimes(result.stderr)
+  totalTime = sum(
+    aTime['cumulative'] for aTime in importTimes.values() if aTime['topLevel']
+  )
+  return result.returncode, totalTime, importTimes
+
+def measureScenario(scenarioName, pythonCode, repeat, top) :
+  totalTimes = []
+  importTimes = {}
+  returnCode = 0
+  for aRun in range(max(1, repeat)) :
+    returnCode, totalTime, importTimes = runScenario(pythonCode)
+    totalTimes.append(totalTime)
+
+  slowestImports = sorted(
+    importTimes.items(), key=lambda anItem : anItem[1]['self'], reverse=True
+  )[:top]
+  return {
+    'code'          : pythonCode,
+    'returnCode'    : returnCode,
+    'medianTotalUs' : int(statistics.median(totalTimes)),
+    'minTotalUs'    : min(totalTimes),
+    'maxTotalUs'    : max(totalTimes),
+    'numModules'    : len(importTimes),
+    'heavyModules'  : [
+      aModule for aModule in heavyModules if aModule in importTimes
+    ],
+    'slowestImports' : [
+      { 'module' : aModule, 'selfUs' : aTime['self'], 'cumulativeUs' : aTime['cumulative'] }
+        for aModule, aTime in slowestImports
+    ],
+  }
+
+def compareWithBaseline(results, baseline, threshold) :
+  regressions = []
+  for scenarioName, aResult in results['scenarios'].items() :
+    if scenarioName not in baseline.get('scenarios', {}) : continue
+    baseTime = baseline['scenarios'][scenarioName]['medianTotalUs']
+    newTime  = aResult['medianTotalUs']
+    ratio = newTime / baseTime if baseTime else 1.0
+    aResult['baselineTotalUs'] = baseTime
+    aResult['ratio'] = round(ratio, 3)
+    click.echo("{:12} {:>10} us (baseline {:>10} us) x{:.2f}".format(
+      scenarioName, newTime, baseTime, ratio
+    ))
+    if threshold < ratio :
+      regressions.append(scenarioName)
+  return regressions
+
+@click.command()
+@click.option("-o", "--output", default=None,
+  help="Write the (JSON) results to this file.")
+@click.option("-b", "--baseline", default=None,
+  help="Compare the results with this (JSON) results file.")
+@click.option("-t", "--threshold", default=1.25, show_default=True, type=float,
+  help="The (baseline) slowdown ratio treated as a regression.")
+@click.option("-r", "--repeat", default=5, show_default=True, type=int,
+  help="The number of times each scenario is run.")
+@click.option("--top", default=10, show_default=True, type=int,
+  help="The number of slowest imports to record for each scenario.")
+def importTime(output, baseline, threshold, repeat, top) :
+  """
+  records the import time of the cpb entry point.
+  """
+  results = {
+    'python'    : sys.version,
+    'repeat'    : repeat,
+    'scenarios' : {},
+  }
+  for scenarioName, pythonCode in scenarios.items() :
+    aResult = measureScenario(scenarioName, pythonCode, repeat, top)
+    results['scenarios'][scenarioName] = aResult
+    click.echo("{:12} {:>10} us {:4} modules heavy: {}".format(
+      scenarioName, aResult['medianTotalUs'], aResult['numModules'],
+      ", ".join(aResult['heavyModules']) or "none"
+    ))
+
+  regressions = []
+  if baseline is not None :
+    with open(baseline) as baselineFile :
+      regressions = compareWithBaseline(results, json.load(baselineFile), threshold)
+
+  if output is not None :
+    with open(output, 'w') as outputFile :
+      json.dump(results, outputFile, indent=2)
+
+  if regressions :
+    click.echo("Import time regressions: {}".format(", ".join(regressions)))
+    sys.exit(-1)
+
+if __name__ == '__main__' :
+  importTime()
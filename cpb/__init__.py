@@ -1,220 +1,59 @@
 # This is the ComputePodsBuilder (cpb) package
 
 import click
-import logging
-import os
-import platform
-import sys
-import yaml
-
-import cpb.build
-import cpb.config
-import cpb.create
-from cpb.utils import *
-
-########################################################################
-# Handle configuration
-
-defaultConfig = {
-  'configYaml'              : "config.yaml",
-  'imageYaml'               : "image.yaml",
-  'cpfYaml'                 : "cpf.yaml",
-  'passwordsYaml'           : "passwords.yaml",
-  'passwordLength'          : 16,
-  'cekitConfig'             : "cekit.ini",
-  'buildBaseDir'            : os.path.join("~", ".local", "computePods"),
-  'certificateAuthorityDir' : "certAuthority",
-  'podsDir'                 : "pods",
-  'usersDir'                : "users",
-  'verbose'                 : False
-}
-
-defaultNatsDefaults = {
-  'hosts'                 : [],
-  'ports'                 : {  # NOTE: all ports must be mapped explicitly (or the external port will be chosen randomly)
-    'natsMsgs'            : '4222:4222',
-    #'natsRouting'        : '6222:6222',
-    #'natsMonitor'        : '8222:8222',
-  },
-  'volumes'               : [],
-  'envs'                  : {
-    'ENV' : '/root/.ashrc'
-  },
-  'shell'                 : '/bin/ash',
-  'secrets'               : [],
-  'images'                : [
-    'natsServer',
-  ],
-  'baseImages'            : [],
-  'maxLoadPerCPU'         : 2
-}
-
-defaultMajorDomoDefaults = {
-  'hosts'                 : [],
-  'ports'                 : {  # NOTE: all ports must be mapped explicitly (or the external port will be chosen randomly)
-    'majorDomo'           : '127.0.0.1:8000:8000', # exposed ONLY on the local host
-  },
-  'volumes'               : [
-    '~/.local/cpmd:/cpmd',
-    '~/GitTools/computePods/interfaces/cpinterfaces:/cpinterfaces',
-    '~/GitTools/computePods/pythonUtils/cputils:/cputils',
-    '~/GitTools/computePods/majorDomo:/root/majorDomo'
-  ],
-  'envs'                  : {
-    'ENV' : '/root/.ashrc'
-  },
-  'shell'                 : '/bin/ash',
-  'secrets'               : [],
-  'images'                : [
-    'majorDomoServer',
-  ],
-  'baseImages'            : [],
-  'maxLoadPerCPU'         : 2
-}
-
-defaultPodDefaults = {
-  'hosts'                 : [],
-  'ports'                 : {  # NOTE: all ports must be mapped explicitly (or the external port will be chosen randomly)
-  },
-  'volumes'               : [],
-  'envs'                  : {},
-  'shell'                 : '/bin/sh',
-  'secrets'               : [],
-  'images'                : [],
-  'baseImages'            : [],
-  'maxLoadPerCPU'         : 2
-}
-
-def loadConfig(configPath, verbose):
-  # Start with the default configuration (above)
-  config = defaultConfig
-
-  # Add the global configuration (if any)
-  configPath = os.path.abspath(os.path.expanduser(configPath))
-  try:
-    globalConfigFile = open(configPath)
-    globalConfig = yaml.safe_load(globalConfigFile)
-    globalConfigFile.close()
-    if globalConfig is not None :
-      config.update(globalConfig)
-  except :
-    if verbose is not None and verbose :
-      print("INFO: no global configuration file found: [{}]".format(configPath))
-
-  # Now add in any local configuration
-  try:
-    localConfigFile = open(config['configYaml'], 'r')
-    localConfig = yaml.safe_load(localConfigFile)
-    localConfigFile.close()
-    if localConfig is not None :
-      config.update(localConfig)
-  except :
-    if verbose is not None and verbose :
-      print("INFO: no local configuration file found: [{}]".format(config['configYaml']))
-
-  # Now add in command line argument/options
-  if verbose is not None :
-    config['verbose'] = verbose
-  if configPath is not None :
-    config['configPath'] = configPath
-  else:
-    print("ERROR: a configPath must be specified!")
-    sys.exit(-1)
-
-  # Now sanitize any known configurable paths
-  sanitizeFilePath(config, 'configPath', None)
-  config['configDir'] = os.path.dirname(configPath)
-  sanitizeFilePath(config, 'cekitConfig', config['configDir'])
-
-  sanitizeFilePath(config, 'imageYaml', None)
-  sanitizeFilePath(config, 'cpfYaml', None)
-  config['curDir'] = os.path.abspath(os.getcwd())
-  config['homeDir'] = os.path.expanduser("~")
-
-  # Now add in the cpb.yaml (if it exists)
-  config['passwords'] = {
-    'ca'    : {},
-    'pods'  : {},
-    'users' : {}
-  }
-  try:
-    passwordsFile = open(config['passwordsYaml'], 'r')
-    passwords = yaml.safe_load(passwordsFile)
-    passwordsFile.close()
-    if passwords is not None :
-      if 'ca' not in passwords :
-        passwords['ca'] = {}
-      if 'pods' not in passwords :
-        passwords['pods'] = {}
-      if 'nats' not in passwords :
-        passwords['nats'] = {}
-      if 'users' not in passwords :
-        passwords['users'] = {}
-      config['passwords'] = passwords
-  except IOError :
-    if verbose is not None and verbose :
-      print("INFO: could not load the passwords file: [{}]".format(config['passwordsYaml']))
-  except Exception as e :
-    if verbose is not None and verbose :
-      print("INFO: could not load the passwords file: [{}]".format(config['passwordsYaml']))
-      print("\t" + "\n\t".join(str(e).split('\n')))
-
-
-  # Now add in the cpb.yaml (if it exists)
-  config['cpf'] = {}
-  try:
-    cpfFile = open(config['cpfYaml'], 'r')
-    cpf = yaml.safe_load(cpfFile)
-    cpfFile.close()
-    if cpf is not None :
-      config['cpf'] = cpf
-  except IOError :
-    if verbose is not None and verbose :
-      print("INFO: could not load the cpf file: [{}]".format(config['cpfYaml']))
-  except Exception as e :
-    if verbose is not None and verbose :
-      print("INFO: could not load the cpf file: [{}]".format(config['cpfYaml']))
-      print("\t" + "\n\t".join(str(e).split('\n')))
-  podDefaults = {}
-  if 'podDefaults' in config['cpf'] :
-    podDefaults = config['cpf']['podDefaults']
-  mergePodDefaults(podDefaults, defaultPodDefaults)
-  config['cpf']['podDefaults']  = podDefaults
-
-  natsDefaults = {}
-  if 'natsDefaults' in config['cpf'] :
-    natsDefaults = config['cpf']['natsDefaults']
-  mergePodDefaults(natsDefaults, defaultNatsDefaults)
-  config['cpf']['natsDefaults'] = natsDefaults
-
-  majorDomoDefaults = {}
-  if 'majorDomoDefaults' in config['cpf'] :
-    majorDomoDefaults = config['cpf']['majorDomoDefaults']
-  mergePodDefaults(majorDomoDefaults, defaultMajorDomoDefaults)
-  config['cpf']['majorDomoDefaults'] = majorDomoDefaults
-
-  # Now add in platform parameters
-  thePlatform = {}
-  thePlatform['system']    = platform.system()
-  thePlatform['node']      = platform.node()
-  thePlatform['release']   = platform.release()
-  thePlatform['version']   = platform.version()
-  thePlatform['machine']   = platform.machine()
-  thePlatform['processor'] = platform.processor()
-  config['platform']       = thePlatform
-
-  # Setup logging
-  if config['verbose'] :
-    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.DEBUG)
-  else:
-    logging.basicConfig(format='%(levelname)s: %(message)s')
-
-  return config
+import importlib
 
 ########################################################################
 # Now deal with click commands
+#
+# The subcommands are loaded lazily, so that each subcommand's python
+# module (and its dependencies) is only imported when that subcommand is
+# used. Each subcommand is listed as ("pythonModule:clickCommand", short
+# help) so that `cpb --help` does not need to import any subcommands.
+
+lazyCommands = {
+  'build'  : ('cpb.build:build',   "uses CEKit to build podman images used by this computePod."),
+  'config' : ('cpb.config:config', "List the current configuration and global options."),
+  'create' : ('cpb.create:create', "(re)Creates any missing compute pod descriptions."),
+  'images' : ('cpb.build:images',  "lists the images that will be built by the build command."),
+  'pods'   : ('cpb.create:pods',   "lists the pods that will be created by the create command."),
+  'users'  : ('cpb.create:users',  "lists the users that will be created by the create command."),
+  #'destroy'    : ('cpb.destroy:destroy',  ""),
+  #'enter'      : ('cpb.enter:enter',      ""),
+  #'containers' : ('cpb.lists:containers', ""),
+  #'package'    : ('cpb.package:package',  ""),
+  #'remove'     : ('cpb.remove:remove',    ""),
+  #'run'        : ('cpb.run:run',          ""),
+  #'stop'       : ('cpb.stop:stop',        ""),
+}
 
-@click.group()
+def loadLazyCommand(cmdName) :
+  moduleName, commandName = lazyCommands[cmdName][0].split(':')
+  return getattr(importlib.import_module(moduleName), commandName)
+
+class LazyGroup(click.Group) :
+
+  def list_commands(self, ctx) :
+    return sorted(set(super().list_commands(ctx)) | set(lazyCommands.keys()))
+
+  def get_command(self, ctx, cmdName) :
+    if cmdName in lazyCommands :
+      return loadLazyCommand(cmdName)
+    return super().get_command(ctx, cmdName)
+
+  # List the (lazy) subcommands without importing them
+  def format_commands(self, ctx, formatter) :
+    rows = []
+    for cmdName in self.list_commands(ctx) :
+      if cmdName in lazyCommands :
+        rows.append((cmdName, lazyCommands[cmdName][1]))
+      else :
+        rows.append((cmdName, super().get_command(ctx, cmdName).get_short_help_str()))
+    if rows :
+      with formatter.section("Commands") :
+        formatter.write_dl(rows)
+
+@click.group(cls=LazyGroup)
 @click.option("-v", "--verbose",
   help="Provide more diagnostic output.",
   default=False, is_flag=True)
@@ -238,20 +77,8 @@ def cli(ctx, config_file, verbose):
 
         cpb <<cpbName>> config
   """
+  # The configuration is only loaded by the subcommands which need it
+  # (see cpb.config.getConfig)
   ctx.ensure_object(dict)
-  ctx.obj = loadConfig(config_file, verbose)
-
-cli.add_command(cpb.build.build)
-cli.add_command(cpb.build.images)
-cli.add_command(cpb.config.config)
-cli.add_command(cpb.create.create)
-cli.add_command(cpb.create.pods)
-cli.add_command(cpb.create.users)
-#cli.add_command(cpb.destroy.destroy)
-#cli.add_command(cpb.enter.enter)
-#cli.add_command(cpb.lists.images)
-#cli.add_command(cpb.lists.containers)
-#cli.add_command(cpb.package)
-#cli.add_command(cpb.remove.remove)
-#cli.add_command(cpb.run.run)
-#cli.add_command(cpb.stop.stop)
+  ctx.obj['configFile'] = config_file
+  ctx.obj['verbose']    = verbose
@@ -1,8 +1,10 @@
 # This python3 click subcommand creates the individual podman images
 
 import click
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import importlib.resources
-import jinja2
+import json
 import logging
 import os
 from pathlib import Path
@@ -12,8 +14,16 @@ import string
 import subprocess
 import sys
 import time
+import urllib.request
 import yaml
 
+import cpb.config
+import cpb.configCache
+import cpb.moduleGraph
+import cpb.scheduler
+import cpb.sharedBaseImages
+import cpb.templates
+import cpb.trace
 from cpb.utils import *
 
 defaultCekitImageDescriptions = {
@@ -86,64 +96,128 @@ defaultCekitImageDescriptions = {
 ############################################################################
 # some helper methods
 
-def copyCekitModulesFiles(config) :
+# Render each of the bundled cekit modules' files (into memory)
+#
+def renderCekitModulesFiles(config) :
   #
   # Load the version information
   #
   versionsYAML = importlib.resources.read_text(
     "cpb.cekitModules", "versions.yaml"
   )
-  versionValues = yaml.safe_load(versionsYAML)
+  versionValues = yamlLoad(versionsYAML)
   #
   # Now walk through each cekitModule, render any possible version
-  # information and copy the resulting resources
+  # information
   #
+  renderedFiles = {}
   for aCekitModule in importlib.resources.contents("cpb.cekitModules") :
     if aCekitModule == '__init__.py'   : continue
     if aCekitModule == '__pycache__'   : continue
     if aCekitModule == 'versions.yaml' : continue
-    cekitModuleDir = os.path.join(config['buildCekitModulesDir'], aCekitModule)
-    os.makedirs(cekitModuleDir, exist_ok=True)
     for aFile in importlib.resources.contents("cpb.cekitModules.{}".format(aCekitModule)) :
       if aFile == '__init__.py' : continue
       if aFile == '__pycache__' : continue
-      logging.info("copying cekit module file: {}::{}".format(aCekitModule, aFile))
-      fileContents = importlib.resources.read_text(
-        "cpb.cekitModules.{}".format(aCekitModule), aFile )
-      fileTemplate = jinja2.Template(fileContents)
-      fileContents = fileTemplate.render(versions=versionValues)
+      fileContents = cpb.templates.render(config,
+        "cekitModules/{}/{}".format(aCekitModule, aFile),
+        { 'versions' : versionValues }
+      )
       if aFile.endswith('.yaml') :
-        fileYaml = yaml.safe_load(fileContents)
+        fileYaml = yamlLoad(fileContents)
         #
         # Remove our super-set of the module.yaml format so that
         # the standard Cekit will not have problems...
         #
-        if 'buildModule'    in fileYaml : del fileYaml['buildModule']
-        if 'artifactImages' in fileYaml : del fileYaml['artifactImages']
-        fileContents = yaml.dump(fileYaml)
-      with open(os.path.join(cekitModuleDir, aFile), 'w') as outFile :
-        outFile.write(fileContents)
+        if 'buildModule' in fileYaml or 'artifactImages' in fileYaml :
+          if 'buildModule'    in fileYaml : del fileYaml['buildModule']
+          if 'artifactImages' in fileYaml : del fileYaml['artifactImages']
+          fileContents = yaml.dump(fileYaml)
+      renderedFiles[os.path.join(aCekitModule, aFile)] = fileContents.encode()
+  return renderedFiles
+
+# Stage the bundled cekit modules in the buildCekitModulesDir. Only files
+# whose contents have changed are (atomically) rewritten, so that the
+# modification times of unchanged files are preserved. Any files which
+# are no longer part of the bundled modules are removed.
+#
+def copyCekitModulesFiles(config) :
+  with cpb.trace.phase('copyCekitModulesFiles') :
+    stageCekitModulesFiles(config)
+
+def stageCekitModulesFiles(config) :
+  stagingDir = config['buildCekitModulesDir']
+  renderedFiles = renderCekitModulesFiles(config)
+
+  for aRelPath, fileContents in renderedFiles.items() :
+    aPath = os.path.join(stagingDir, aRelPath)
+    try :
+      with open(aPath, 'rb') as oldFile :
+        if hashlib.sha256(oldFile.read()).digest() == hashlib.sha256(fileContents).digest() :
+          continue
+    except IOError :
+      pass
+    logging.info("copying cekit module file: {}".format(aRelPath))
+    os.makedirs(os.path.dirname(aPath), exist_ok=True)
+    tmpPath = aPath + '.tmp-{}'.format(os.getpid())
+    with open(tmpPath, 'wb') as outFile :
+      outFile.write(fileContents)
+    os.replace(tmpPath, aPath)
+
+  for aRoot, someDirs, someFiles in os.walk(stagingDir, topdown=False) :
+    for aFile in someFiles :
+      aPath = os.path.join(aRoot, aFile)
+      if os.path.relpath(aPath, stagingDir) not in renderedFiles :
+        logging.info("removing old cekit module file: {}".format(aPath))
+        os.remove(aPath)
+    if aRoot != stagingDir and not os.listdir(aRoot) :
+      os.rmdir(aRoot)
 
 ############################################################################
 # Configuration
 
-def loadCekitModules(config) :
-  config['modules'] = {}
-  modules = config['modules']
-
-  for aRepo in config['repositories'] :
-    for aModule in os.listdir(aRepo) :
-      modules[aModule] = {}
-
-      cekitModulePath = os.path.join(aRepo, aModule, 'module.yaml')
-      if os.path.isfile(cekitModulePath) :
-        try:
-          with open(cekitModulePath, 'r') as moduleFile :
-            logging.info("Loading {}::module.yaml\n      from {}".format(aModule, aRepo))
-            modules[aModule] = yaml.safe_load(moduleFile)
-        except Exception as e :
-          logging.info("Could not load the {} YAML file.".format(cekitModulePath))
-          print("  > " + "\n  >".join(str(e).split("\n")))
+# Find the images (from amongst the `imageKeys`) which must be built
+# before each image can be built. An image depends upon any image it is
+# basedOn, any image its build stage (if any buildModules) is basedOn, as
+# well as any artifactImages used by its modules.
+#
+def computeImageParents(imageKeys, imageDescs) :
+  knownImages = {}
+  for anImageKey in imageKeys :
+    if anImageKey not in imageDescs : continue
+    knownImages[imageDescs[anImageKey]['imageName'].lower()] = anImageKey
+
+  def findImage(anImageRef) :
+    anImageRef = anImageRef.lower()
+    if anImageRef in knownImages :
+      return knownImages[anImageRef]
+    return knownImages.get(anImageRef.rsplit(':', 1)[0], None)
+
+  imageParents = {}
+  for anImageKey in imageKeys :
+    if anImageKey not in imageDescs : continue
+    anImageDesc = imageDescs[anImageKey]
+    imageRefs = [ anImageDesc['basedOn'] ]
+    if 'buildModules' in anImageDesc :
+      imageRefs.append(anImageDesc['buildBasedOn'])
+    if 'artifactImages' in anImageDesc :
+      imageRefs.extend(anImageDesc['artifactImages'])
+    parents = []
+    for anImageRef in imageRefs :
+      aParent = findImage(anImageRef)
+      if aParent is not None and aParent != anImageKey and aParent not in parents :
+        parents.append(aParent)
+    imageParents[anImageKey] = parents
+  return imageParents
+
+# The module.yaml files and module repositories used to normalize the
+# configuration (see cpb.configCache)
+#
+def normalizeConfigInputs(config) :
+  moduleFiles = [
+    os.path.join(aModuleDir, 'module.yaml')
+      for aModuleDir in config['moduleDirs'].values()
+  ]
+  return moduleFiles, config['repositories']
 
 def normalizeConfig(config) :
 
@@ -195,6 +269,10 @@ def normalizeConfig(config) :
     if 'images' in aPod :
       for anImage in aPod['images'] :
         images[anImage] = True
+  # (images placed by cpb.placement are also used)
+  for anImage, anImageDesc in config['cpf']['cekitImageDescriptions'].items() :
+    if isinstance(anImageDesc, dict) and 'placement' in anImageDesc :
+      images[anImage] = True
 
   defaultImageDesc = defaultCekitImageDescriptions['defaults']
   config['buildCekitModulesDir'] = os.path.join(config['buildDir'], 'cekitModules')
@@ -206,12 +284,16 @@ def normalizeConfig(config) :
   imageDescs['defaults']['repositories'].insert(0, config['buildCekitModulesDir'])
   imageDefaults = imageDescs['defaults']
 
-  copyCekitModulesFiles(config)
+  # Commands which do not build images (see the images command) only need
+  # to stage the bundled cekit modules if they have never been staged
+  if config.get('stageCekitModules', True) \
+    or not os.path.isdir(config['buildCekitModulesDir']) :
+    copyCekitModulesFiles(config)
 
   config['repositories'] = []
   for aRepo in imageDescs['defaults']['repositories'] :
     config['repositories'].append(aRepo)
-  loadCekitModules(config)
+  cpb.moduleGraph.initModuleGraph(config)
 
   # Process the user's image definitions
   #
@@ -238,64 +320,341 @@ def normalizeConfig(config) :
   for anImageName in baseImages.keys() :
     imageDescs[anImageName]['imageName'] = imageDescs[anImageName]['name']
   #
+  # Factor any common module prefixes out into shared base images (if
+  # requested, see cpb.sharedBaseImages)
+  #
+  sharedImages = cpb.sharedBaseImages.addSharedBaseImages(
+    config, list(baseImages.keys()) + list(images.keys()), imageDescs
+  )
+  #
   # Now add any required build modules
   #
   #print("--------------------------------------------------------------")
   #print(yaml.dump(config))
   #print("--------------------------------------------------------------")
-  modules = config['modules']
-  for anImageName, anImageDesc in imageDescs.items() :
-    if anImageName != 'defaults' :
-      buildModules = []
-      artifactImages = {}
-
-      for aModule in anImageDesc['modules'] :
-        if aModule not in modules :
-          logging.error("No {} module found while defining the {} image".format(aModule, anImageName))
-          sys.exit(-1)
-
-        if 'buildModule' in modules[aModule] :
-          buildModules.append(modules[aModule]['buildModule'])
-        if 'artifactImages' in modules[aModule] :
-          for anArtifactImage in modules[aModule]['artifactImages'] :
-            artifactImages[anArtifactImage] = True
-      if buildModules :
-        anImageDesc['buildModules'] = buildModules
-      if artifactImages :
-        anImageDesc['artifactImages'] = list(artifactImages.keys())
-
-  config['baseImagesToBuild'] = list(baseImages.keys())
+  # (only the modules reachable from the images we build are loaded)
+  #
+  for anImageName in sharedImages + list(baseImages.keys()) + list(images.keys()) :
+    if anImageName not in imageDescs : continue
+    anImageDesc = imageDescs[anImageName]
+    buildModules = []
+    artifactImages = {}
+
+    for aModule in anImageDesc['modules'] :
+      aModuleYaml = cpb.moduleGraph.loadModule(config, aModule)
+      if aModuleYaml is None :
+        logging.error("No {} module found while defining the {} image".format(aModule, anImageName))
+        sys.exit(-1)
+
+      if 'buildModule' in aModuleYaml :
+        buildModules.append(aModuleYaml['buildModule'])
+      if 'artifactImages' in aModuleYaml :
+        for anArtifactImage in aModuleYaml['artifactImages'] :
+          artifactImages[anArtifactImage] = True
+    if buildModules :
+      anImageDesc['buildModules'] = buildModules
+    if artifactImages :
+      anImageDesc['artifactImages'] = list(artifactImages.keys())
+
+    # load (and check for cycles in) all of the modules this image installs
+    cpb.moduleGraph.imageModules(config, anImageDesc)
+
+  config['baseImagesToBuild'] = sharedImages + list(baseImages.keys())
   config['imagesToBuild'] = list(images.keys())
+  config['imageParents'] = computeImageParents(
+    config['baseImagesToBuild'] + config['imagesToBuild'], imageDescs
+  )
 
   if config['verbose'] :
     logging.info("configuration:\n------\n" + yaml.dump(config) + "------\n")
 
+############################################################################
+# Image fingerprints
+#
+# Each image is given a fingerprint which is the SHA256 hash of everything
+# which goes into building it:
+#   - the rendered image.yaml,
+#   - every file of every module it (transitively) installs,
+#   - the bundled versions.yaml,
+#   - the images it is based upon (and the fingerprints of any of these
+#     images which we also build).
+#
+# The fingerprint is stored as a label on the image, so that an image is
+# only rebuilt when its fingerprint changes.
+#
+# An image's fingerprint combines its own fingerprint (everything except
+# its parents) with the fingerprints of its parents. When an image is
+# built, the fingerprints (labels) of the parent images it is *actually*
+# built upon are used, so that an image built upon an out of date parent
+# (which was not overwritten) is rebuilt once that parent is rebuilt.
+
+fingerprintLabel = 'io.github.computepods.fingerprint'
+
+def renderImageYaml(anImageDesc, config, fingerprint=None) :
+  templateValues = dict(anImageDesc)
+  if fingerprint is not None :
+    templateValues['fingerprint']      = fingerprint
+    templateValues['fingerprintLabel'] = fingerprintLabel
+  return cpb.templates.render(config, 'resources/cekitImage.yaml.j2', templateValues)
+
+def hashDirectory(aHash, aDir) :
+  for aRoot, someDirs, someFiles in os.walk(aDir) :
+    someDirs[:] = sorted(aSubDir for aSubDir in someDirs if aSubDir != '__pycache__')
+    for aFile in sorted(someFiles) :
+      aPath = os.path.join(aRoot, aFile)
+      aHash.update(os.path.relpath(aPath, aDir).encode())
+      with open(aPath, 'rb') as aFileObj :
+        aHash.update(hashlib.sha256(aFileObj.read()).digest())
+
+def ownFingerprintOf(anImageDesc, config, versionsYAML) :
+  aHash = hashlib.sha256()
+  aHash.update(renderImageYaml(anImageDesc, config).encode())
+  aHash.update(versionsYAML.encode())
+  aHash.update(anImageDesc['basedOn'].encode())
+  aHash.update(anImageDesc['buildBasedOn'].encode())
+  for aModule in cpb.moduleGraph.imageModules(config, anImageDesc) :
+    aHash.update(aModule.encode())
+    if aModule in config['moduleDirs'] :
+      hashDirectory(aHash, config['moduleDirs'][aModule])
+  return aHash.hexdigest()
+
+def combineFingerprints(ownFingerprint, parentFingerprints) :
+  aHash = hashlib.sha256()
+  aHash.update(ownFingerprint.encode())
+  for aParentFingerprint in parentFingerprints :
+    aHash.update(aParentFingerprint.encode())
+  return aHash.hexdigest()
+
+# Returns the (expected) fingerprints of the images (assuming all of
+# their parents are up to date) together with their own fingerprints.
+#
+def computeImageFingerprints(imageKeys, imageDescs, config) :
+  versionsYAML = importlib.resources.read_text(
+    "cpb.cekitModules", "versions.yaml"
+  )
+  fingerprints    = {}
+  ownFingerprints = {}
+
+  def fingerprintOf(anImageKey) :
+    if anImageKey in fingerprints :
+      return fingerprints[anImageKey]
+    ownFingerprints[anImageKey] = ownFingerprintOf(
+      imageDescs[anImageKey], config, versionsYAML
+    )
+    fingerprints[anImageKey] = combineFingerprints(
+      ownFingerprints[anImageKey],
+      [ fingerprintOf(aParent) for aParent in config['imageParents'].get(anImageKey, []) ]
+    )
+    return fingerprints[anImageKey]
+
+  for anImageKey in imageKeys :
+    if anImageKey in imageDescs :
+      fingerprintOf(anImageKey)
+  return fingerprints, ownFingerprints
+
+def existingFingerprint(imageNameLower, imageVersion) :
+  inspectFormat = "'{{{{ index .Labels \"{}\" }}}}'".format(fingerprintLabel)
+  for anImageRef in [ imageNameLower, "{}:{}".format(imageNameLower, imageVersion) ] :
+    returnCode, fingerprint = captureCommand(
+      "podman image inspect --format {} {}".format(inspectFormat, anImageRef)
+    )
+    if returnCode == 0 :
+      return fingerprint
+  return None
+
+############################################################################
+# PreBuild scripts
+#
+# Any module (reachable from the images being built) may contain
+# executable `preBuild.*` scripts which prepare the module's files before
+# any image is built. The scripts of a module are only run after the
+# scripts of all of the modules it (transitively) installs.
+#
+# After the scripts of a module have successfully run, the hash of the
+# module's directory is saved in a stamp file. The scripts are not run
+# again until the module's directory changes.
+
+def preBuildScriptsOf(aModuleDir) :
+  preBuildScripts = []
+  for aPreBuildScript in sorted(Path(aModuleDir).glob('**/preBuild.*')) :
+    if not aPreBuildScript.is_file() : continue
+    if not os.access(str(aPreBuildScript), os.X_OK) :
+      print(f"The PreBuild script:\n  {aPreBuildScript}\nis NOT executable")
+      continue
+    preBuildScripts.append(aPreBuildScript)
+  return preBuildScripts
+
+def moduleDirHash(aModuleDir) :
+  aHash = hashlib.sha256()
+  hashDirectory(aHash, aModuleDir)
+  return aHash.hexdigest()
+
+def runModulePreBuildScripts(aModule, preBuildScripts, config) :
+  aModuleDir = config['moduleDirs'][aModule]
+  preBuildDir = os.path.join(config['buildDir'], 'preBuild')
+  stampPath = os.path.join(preBuildDir, aModule + '.stamp')
+  logPath   = os.path.join(preBuildDir, aModule + '.log')
+
+  try :
+    with open(stampPath) as stampFile :
+      if stampFile.read().strip() == moduleDirHash(aModuleDir) :
+        print(f"\nThe {aModule} module has not changed (NOT running its preBuild scripts)")
+        return True
+  except IOError :
+    pass
+
+  os.makedirs(preBuildDir, exist_ok=True)
+  with open(logPath, 'w') as logFile :
+    for aPreBuildScript in preBuildScripts :
+      print(f"\nPreBuilding the {aModule} module using the script:\n  {aPreBuildScript}")
+      logFile.write(f"---- {aPreBuildScript}\n")
+      logFile.flush()
+      with cpb.trace.subprocessPhase(aPreBuildScript, aPreBuildScript.parent) as traceArgs :
+        result = subprocess.run(
+          str(aPreBuildScript), cwd=aPreBuildScript.parent,
+          stdout=logFile, stderr=subprocess.STDOUT
+        )
+        traceArgs['module']   = aModule
+        traceArgs['exitCode'] = result.returncode
+      if result.returncode != 0 :
+        logging.error(f"The preBuild script {aPreBuildScript} failed (see: {logPath})")
+        if os.path.exists(stampPath) : os.remove(stampPath)
+        return False
+
+  with open(stampPath, 'w') as stampFile :
+    stampFile.write(moduleDirHash(aModuleDir) + "\n")
+  return True
+
+def tracedPreBuild(aModule, preBuildScripts, config) :
+  with cpb.trace.phase('preBuild', module=aModule) as traceArgs :
+    traceArgs['succeeded'] = runModulePreBuildScripts(aModule, preBuildScripts, config)
+  return traceArgs['succeeded']
+
+def runPreBuildScripts(imageKeys, imageDescs, config, jobs) :
+  someModules = []
+  for anImageKey in imageKeys :
+    if anImageKey not in imageDescs : continue
+    for aModule in cpb.moduleGraph.imageModules(config, imageDescs[anImageKey]) :
+      if aModule not in someModules :
+        someModules.append(aModule)
+
+  preBuildScripts = {}
+  for aModule in someModules :
+    if aModule not in config['moduleDirs'] : continue
+    someScripts = preBuildScriptsOf(config['moduleDirs'][aModule])
+    if someScripts :
+      preBuildScripts[aModule] = someScripts
+  if not preBuildScripts :
+    return True
+
+  moduleParents = {
+    aModule : cpb.moduleGraph.moduleClosure(config, aModule)[1:]
+      for aModule in preBuildScripts
+  }
+  succeeded, failed, notRun = cpb.scheduler.runDag(
+    list(preBuildScripts.keys()), moduleParents,
+    lambda aModule : tracedPreBuild(aModule, preBuildScripts[aModule], config),
+    jobs
+  )
+  if failed :
+    logging.error("Failed to preBuild the modules: {}".format(", ".join(failed)))
+    if notRun :
+      logging.error("NOT preBuilding the modules: {}".format(", ".join(notRun)))
+    return False
+  return True
+
 ############################################################################
 # Do the work...
 
-def pushToRegistry(imageName, registry) :
-    registryFlag, registryPath = getRegistryFlagAndPath(imageName, registry)
+# Find the digest of the image's configuration blob as known to the
+# registry, by asking the registry (using its HTTP API) for the manifest
+# of the `latest` tag. Since podman uses the digest of an image's
+# configuration as the image's ID, this digest can be compared with the
+# local image's ID. Returns None if the registry can not tell us.
+#
+def registryConfigDigest(registryPath, registry) :
+  if '/' not in registryPath :
+    return None
+  registryHost, repoPath = registryPath.split('/', 1)
+  scheme = 'http'
+  if 'isSecure' in registry and registry['isSecure'] :
+    scheme = 'https'
+  manifestUrl = "{}://{}/v2/{}/manifests/latest".format(
+    scheme, registryHost, repoPath.lstrip('/')
+  )
+  manifestRequest = urllib.request.Request(manifestUrl, headers={
+    'Accept' : ", ".join([
+      'application/vnd.oci.image.manifest.v1+json',
+      'application/vnd.docker.distribution.manifest.v2+json'
+    ])
+  })
+  try :
+    with urllib.request.urlopen(manifestRequest, timeout=30) as response :
+      manifest = json.loads(response.read().decode())
+    return manifest['config']['digest']
+  except Exception as err :
+    logging.info("Could not get the manifest {}: {}".format(manifestUrl, repr(err)))
+    return None
+
+def pushToRegistry(imageName, registry, logPath=None) :
+  registryFlag, registryPath = getRegistryFlagAndPath(imageName, registry)
+
+  returnCode, localImageId = captureCommand(
+    "podman image inspect --format '{{{{.Id}}}}' {}".format(imageName.lower())
+  )
+  if returnCode == 0 and localImageId :
+    remoteDigest = registryConfigDigest(registryPath, registry)
+    if remoteDigest is not None and remoteDigest.split(':')[-1] == localImageId.split(':')[-1] :
+      click.echo("The {} image is already in the registry (not pushing)".format(imageName))
+      return True
+
+  retries = registry.get('pushRetries', 3)
+  cmd = "podman push {} {} docker://{}".format(registryFlag, imageName.lower(), registryPath)
+  for anAttempt in range(retries + 1) :
+    if 0 < anAttempt :
+      backOff = 2 ** anAttempt
+      logging.warning("Retrying the push of the {} image in {} seconds".format(imageName, backOff))
+      time.sleep(backOff)
+    logging.info("pushing image using:\n  {}".format(cmd))
     try:
-      cmd = "podman push {} {} docker://{}".format(registryFlag, imageName.lower(), registryPath)
-      logging.info("pushing image using:\n  {}".format(cmd))
-      os.system(cmd)
+      if logPath is None :
+        returnCode = runCommand(cmd)
+      else :
+        with open(logPath, 'a') as logFile :
+          returnCode = runCommand(cmd, logFile=logFile)
     except Exception as err :
-      logging.error("Could not push the {} image to the {} registry.".format(imageName, registryPath))
-      logging.error("Do you need to login to the registry using podman?")
       logging.error(err)
-
-def buildAnImage(anImageKey, imageDescs, config, overwrite, push) :
+      returnCode = -1
+    if returnCode == 0 :
+      click.echo("Pushed the {} image to {}".format(imageName, registryPath))
+      return True
+
+  logging.error("Could not push the {} image to the {} registry.".format(imageName, registryPath))
+  logging.error("Do you need to login to the registry using podman?")
+  if logPath is not None :
+    logging.error("  see the push log: {}".format(logPath))
+  return False
+
+# The `pushImage` function (if not None) is used to (queue the) push of
+# the image to the federation's registry. The fingerprint of any image
+# which is built (or is up to date) is recorded in the (optional)
+# `builtFingerprints`.
+#
+def buildAnImage(anImageKey, imageDescs, config, overwrite, pushImage, fingerprint, quiet=False, builtFingerprints=None, imageLabels=None) :
+  if builtFingerprints is None :
+    builtFingerprints = {}
+  if imageLabels is None :
+    imageLabels = {}
+  builtFingerprints.pop(anImageKey, None)
   if anImageKey not in imageDescs :
     click.echo("No cekit image description provided for the {} image!".format(anImageKey))
-    sys.exit(-1)
+    return False
 
   imageDir = os.path.join(config['buildDir'], anImageKey)
   fileName = 'image.yaml'
   os.makedirs(imageDir, exist_ok=True)
-  cekitImageJ2 = importlib.resources.read_text('cpb.resources', 'cekitImage.yaml.j2')
   try:
-    template = jinja2.Template(cekitImageJ2)
-    fileContents = template.render(imageDescs[anImageKey])
+    fileContents = renderImageYaml(imageDescs[anImageKey], config, fingerprint)
     with open(os.path.join(imageDir, "image.yaml"), 'w') as outFile :
       outFile.write(fileContents)
   except Exception as err:
@@ -306,37 +665,207 @@ def buildAnImage(anImageKey, imageDescs, config, overwrite, push) :
   imageNameLower = imageName.lower()
   imageVersion = imageDescs[anImageKey]['version']
   click.echo("\nChecking if the {} image exists".format(imageName))
-  if ((os.system("podman image exists {}".format(imageNameLower)) == 0) or
-    (os.system("podman image exists {}:{}".format(imageNameLower, imageVersion)) == 0)) :
-    if push and 'registry' in config['cpf'] :
-      pushToRegistry(imageName, config['cpf']['registry'])
-      return
+  oldFingerprint = existingFingerprint(imageNameLower, imageVersion)
+  if oldFingerprint is not None :
+    if oldFingerprint == fingerprint :
+      click.echo("The {} image is up to date.".format(imageName))
+      builtFingerprints[anImageKey] = fingerprint
+      imageLabels[anImageKey] = fingerprint
+      if pushImage is not None :
+        pushImage(anImageKey, imageName)
+      return True
     else:
       if not overwrite :
-        click.echo("The {} image already exists and won't be overwritten.".format(imageName))
-        click.echo("  use the --overwrite option to overwrite this image.")
-        return
+        click.echo("The {} image is out of date but won't be overwritten.".format(imageName))
+        click.echo("  use the --overwrite option to rebuild this image.")
+        # (any images built upon this image record its old fingerprint)
+        imageLabels[anImageKey] = oldFingerprint
+        if pushImage is not None :
+          pushImage(anImageKey, imageName)
+        return True
       else:
-        click.echo("Removing the {} image".format(imageName))
-        os.system("podman image rm {}".format(imageNameLower))
+        click.echo("Removing the out of date {} image".format(imageName))
+        runCommand("podman image rm {}".format(imageNameLower))
         time.sleep(1)
         click.echo("Removing the {}:{} image".format(imageName, imageVersion))
-        os.system("podman image rm {}:{}".format(imageNameLower, imageVersion))
+        runCommand("podman image rm {}:{}".format(imageNameLower, imageVersion))
 
+  # When building more than one image at a time, the CEKit output is
+  # collected in a log file (in the image's build directory) so that the
+  # output of the concurrent builds is not interleaved.
+  #
+  logPath = os.path.join(imageDir, 'cekit-build.log')
   try:
-    os.chdir(imageDir)
-    click.echo("----------------------------------------------------------")
-    click.echo("Using CEKit to build the {} image".format(anImageKey))
-    click.echo("in the {} directory".format(imageDir))
-    click.echo("----------------------------------------------------------")
-    os.system("cekit build podman")
-    click.echo("----------------------------------------------------------")
+    if quiet :
+      click.echo("Using CEKit to build the {} image (log: {})".format(anImageKey, logPath))
+      with open(logPath, 'w') as logFile :
+        returnCode = runCommand("cekit build podman", cwd=imageDir, logFile=logFile)
+    else :
+      click.echo("----------------------------------------------------------")
+      click.echo("Using CEKit to build the {} image".format(anImageKey))
+      click.echo("in the {} directory".format(imageDir))
+      click.echo("----------------------------------------------------------")
+      returnCode = runCommand("cekit build podman", cwd=imageDir)
+      click.echo("----------------------------------------------------------")
   except Exception as err :
     logging.error("Could not build {} image using CEKit".format(anImageKey))
     logging.error(err)
+    return False
+
+  if returnCode != 0 :
+    logging.error("CEKit failed ({}) to build the {} image".format(returnCode, anImageKey))
+    if quiet :
+      logging.error("  see the build log: {}".format(logPath))
+    return False
+  click.echo("Built the {} image".format(anImageKey))
+  builtFingerprints[anImageKey] = fingerprint
+  imageLabels[anImageKey] = fingerprint
+
+  if pushImage is not None :
+    pushImage(anImageKey, imageName)
+  return True
+
+# The fingerprints of the images successfully built (or found to be up
+# to date) by the last build (used by `--only-changed`)
+#
+def loadBuiltFingerprints(config) :
+  try :
+    with open(os.path.join(config['buildDir'], 'imageFingerprints.yaml')) as fingerprintsFile :
+      builtFingerprints = yamlLoad(fingerprintsFile)
+    if builtFingerprints is not None :
+      return builtFingerprints
+  except IOError :
+    pass
+  return {}
+
+def saveBuiltFingerprints(config, builtFingerprints) :
+  os.makedirs(config['buildDir'], exist_ok=True)
+  with open(os.path.join(config['buildDir'], 'imageFingerprints.yaml'), 'w') as fingerprintsFile :
+    fingerprintsFile.write(yaml.dump(builtFingerprints))
+
+def tracedPush(anImageKey, imageName, registry, logPath) :
+  with cpb.trace.phase('pushImage', image=anImageKey) as traceArgs :
+    traceArgs['succeeded'] = pushToRegistry(imageName, registry, logPath)
+  return traceArgs['succeeded']
+
+def buildImages(ctx, overwrite, push, jobs, push_jobs, imageSelectors=(), onlyChanged=False) :
+  config = cpb.configCache.normalizeWithCache(
+    cpb.config.getConfig(ctx), 'build', normalizeConfig, normalizeConfigInputs
+  )
+  if config['fromConfigCache'] :
+    copyCekitModulesFiles(config)
+
+  if push and 'registry' not in config['cpf'] :
+    click.echo("You have asked to push images to a registry...")
+    click.echo("  ... but you have not specified a registry in the cpf.yaml")
+    click.echo("  we will NOT push images!")
+
+  imageDescs = config['cpf']['cekitImageDescriptions']
+
+  # Build the base images and the container images, starting each image
+  # as soon as all of the images it depends upon have been built
+  imageKeys = []
+  for anImageKey in config['baseImagesToBuild'] + config['imagesToBuild'] :
+    if anImageKey not in imageKeys :
+      imageKeys.append(anImageKey)
+
+  # Only the selected images are built (but the fingerprints are
+  # computed for all of the images, so that they do not depend upon the
+  # selection)
+  selectedKeys = imageKeys
+  if imageSelectors :
+    selectedKeys = [ anImageKey for anImageKey in imageKeys
+      if anImageKey in imageDescs and matchesSelectors(
+        [ anImageKey, imageDescs[anImageKey]['imageName'] ], imageSelectors
+      )
+    ]
+    if not selectedKeys :
+      logging.warning("No images match the selectors: {}".format(", ".join(imageSelectors)))
+
+  # Prebuild step
+  if not runPreBuildScripts(selectedKeys, imageDescs, config, max(1, jobs)) :
+    sys.exit(-1)
 
+  with cpb.trace.phase('fingerprints') :
+    fingerprints, ownFingerprints = computeImageFingerprints(imageKeys, imageDescs, config)
+
+  builtFingerprints = loadBuiltFingerprints(config)
+  if onlyChanged :
+    unchangedKeys = [ anImageKey for anImageKey in selectedKeys
+      if builtFingerprints.get(anImageKey, None) == fingerprints.get(anImageKey, None)
+    ]
+    if unchangedKeys :
+      click.echo("\nUnchanged (not checking): {}".format(", ".join(unchangedKeys)))
+    selectedKeys = [ anImageKey for anImageKey in selectedKeys
+      if anImageKey not in unchangedKeys ]
+
+  # Pushes are queued (as each image becomes available) and run in the
+  # background while the remaining images are built
+  pushExecutor = None
+  pushFutures  = {}
+  pushImage    = None
   if push and 'registry' in config['cpf'] :
-    pushToRegistry(imageName, config['cpf']['registry'])
+    pushExecutor = ThreadPoolExecutor(max_workers=max(1, push_jobs))
+    def queuePush(anImageKey, imageName) :
+      # (shared intermediate images are pushed as part of their children)
+      if imageDescs[anImageKey].get('intermediate', False) :
+        return
+      pushFutures[anImageKey] = pushExecutor.submit(
+        tracedPush, anImageKey, imageName, config['cpf']['registry'],
+        os.path.join(config['buildDir'], anImageKey, 'podman-push.log')
+      )
+    pushImage = queuePush
+
+  # The fingerprints (labels) of the images as they actually are (an out
+  # of date image which is not overwritten keeps its old fingerprint)
+  imageLabels = {}
+
+  def parentLabelOf(aParent) :
+    if aParent not in imageLabels :
+      # (a parent which is not being built by this build)
+      aParentDesc = imageDescs[aParent]
+      imageLabels[aParent] = existingFingerprint(
+        aParentDesc['imageName'].lower(), aParentDesc['version']
+      ) or fingerprints[aParent]
+    return imageLabels[aParent]
+
+  def actualFingerprintOf(anImageKey) :
+    if anImageKey not in ownFingerprints :
+      return None
+    return combineFingerprints(ownFingerprints[anImageKey], [
+      parentLabelOf(aParent) for aParent in config['imageParents'].get(anImageKey, [])
+    ])
+
+  jobs = max(1, jobs)
+  def buildImage(anImageKey) :
+    with cpb.trace.phase('buildImage', image=anImageKey) as traceArgs :
+      traceArgs['succeeded'] = buildAnImage(anImageKey, imageDescs, config,
+        overwrite, pushImage, actualFingerprintOf(anImageKey), quiet=(1 < jobs),
+        builtFingerprints=builtFingerprints, imageLabels=imageLabels)
+    return traceArgs['succeeded']
+
+  succeeded, failed, notBuilt = cpb.scheduler.runDag(
+    selectedKeys, config['imageParents'], buildImage, jobs
+  )
+  saveBuiltFingerprints(config, builtFingerprints)
+
+  pushFailed = []
+  if pushExecutor is not None :
+    if pushFutures :
+      click.echo("\nWaiting for the image pushes to finish")
+    pushExecutor.shutdown(wait=True)
+    for anImageKey, aFuture in pushFutures.items() :
+      if not aFuture.result() :
+        pushFailed.append(anImageKey)
+
+  if failed :
+    logging.error("Failed to build the images: {}".format(", ".join(failed)))
+    if notBuilt :
+      logging.error("NOT building the images: {}".format(", ".join(notBuilt)))
+  if pushFailed :
+    logging.error("Failed to push the images: {}".format(", ".join(pushFailed)))
+  if failed or pushFailed :
+    sys.exit(-1)
 
 
 @click.command("build")
@@ -344,70 +873,79 @@ def buildAnImage(anImageKey, imageDescs, config, overwrite, push) :
   help="Push images to the federation registry.",
   prompt="Do you want to push images to the federation registry?")
 @click.option("-O", "--overwrite", default=False, is_flag=True,
-  help="Allow existing images to be overwritten.",
-  prompt="Do you want to overwite images?")
+  help="Allow existing images, which are out of date, to be rebuilt.",
+  prompt="Do you want to overwite out of date images?")
+@click.option("-j", "--jobs", default=1, show_default=True, type=int,
+  help="The number of images to build at the same time.")
+@click.option("--push-jobs", default=2, show_default=True, type=int,
+  help="The number of images to push to the registry at the same time.")
+@click.option("--trace", "tracePath", default=None,
+  help="Write a (Chrome trace-event) trace of the build to this file.")
+@click.option("--timings", default=False, is_flag=True,
+  help="Print a summary of the time taken by each phase of the build.")
+@click.option("-i", "--image", "imageSelectors", multiple=True,
+  help="Only build the images whose name matches this glob (may be repeated).")
+@click.option("-c", "--only-changed", "onlyChanged", default=False, is_flag=True,
+  help="Only check/build the images whose fingerprint has changed since the last build.")
 @click.pass_context
-def build(ctx, overwrite, push):
+def build(ctx, overwrite, push, jobs, push_jobs, tracePath, timings, imageSelectors, onlyChanged):
   """
   uses CEKit to build podman images used by this computePod.
 
-  """
-  config = ctx.obj
-  normalizeConfig(config)
+  Only the preBuild scripts of modules used by the images being built are
+  run, and only when their module has changed since they last succeeded.
 
-  if push and 'registry' not in config['cpf'] :
-    click.echo("You have asked to push images to a registry...")
-    click.echo("  ... but you have not specified a registry in the cpf.yaml")
-    click.echo("  we will NOT push images!")
+  Images which do not depend upon each other are built at the same time
+  (using at most `--jobs` concurrent builds).
 
-  imageDescs = config['cpf']['cekitImageDescriptions']
+  Images whose fingerprint (a hash of everything used to build the
+  image) has not changed are not rebuilt.
 
-  # Prebuild step
-  for aRepo in config['repositories'] :
-    repoDir = Path(aRepo)
-    for aPreBuildScript in repoDir.glob('**/preBuild.*') :
-      if aPreBuildScript.is_file() \
-        and os.access(str(aPreBuildScript), os.X_OK) :
-        print(f"\nPreBuilding using the script:\n  {aPreBuildScript}")
-        print(f"in the directory:\n  {aPreBuildScript.parent}")
-        print("--------------------------------------------------------")
-        subprocess.run(aPreBuildScript, cwd=aPreBuildScript.parent)
-        print("--------------------------------------------------------")
-      else :
-        print(f"The PreBuild script:\n  {aPreBuildScript}\nis NOT executable")
+  Images are pushed to the registry in the background while other images
+  are being built. Images already in the registry are not pushed again.
 
-  # Start by building any base images we know about
-  for anImageKey in config['baseImagesToBuild'] :
-    buildAnImage(anImageKey, imageDescs, config, overwrite, push)
+  Use --image to only build some of the images, and --only-changed to
+  skip (without asking podman) any images whose fingerprint has not
+  changed since they were last built by cpb.
 
-  # Now build the container images
-  for anImageKey in config['imagesToBuild'] :
-    buildAnImage(anImageKey, imageDescs, config, overwrite, push)
+  Use --trace and/or --timings to find where the build spends its time.
+  """
+  with cpb.trace.tracing(tracePath, timings) :
+    buildImages(ctx, overwrite, push, jobs, push_jobs, imageSelectors, onlyChanged)
 
-def listSubModules(indent, aModule, modules) :
+def listSubModules(indent, aModule, config) :
   print("{}- {}".format(indent, aModule))
-  if aModule in modules :
-    if 'modules' in modules[aModule] :
-      if modules[aModule]['modules'] :
-        if 'install' in modules[aModule]['modules'] :
-          #print(yaml.dump(modules[aModule]['modules']['install']))
-          for aSubModule in modules[aModule]['modules']['install'] :
-            #print(yaml.dump(aSubModule))
-            listSubModules(indent+"  ", aSubModule['name'], modules)
+  for aSubModule in cpb.moduleGraph.subModulesOf(config, aModule) :
+    listSubModules(indent+"  ", aSubModule, config)
 
 @click.command("images")
+@click.option("-a", "--affected-by", "affectedBy", default=None,
+  help="Only list the images which (transitively) install this cekit module.")
 @click.pass_context
-def images(ctx) :
+def images(ctx, affectedBy) :
   """
   lists the images that will be built by the build command.
+
+  Use the --affected-by option to list only the images which would need to
+  be rebuilt if the given cekit module changed.
   """
 
-  config = ctx.obj
-  normalizeConfig(config)
+  config = cpb.config.getConfig(ctx)
+  config['stageCekitModules'] = False
+  config = cpb.configCache.normalizeWithCache(
+    config, 'build', normalizeConfig, normalizeConfigInputs
+  )
 
   imagesToBuild = config['imagesToBuild'] + config['baseImagesToBuild']
 
   imageDescs = config['cpf']['cekitImageDescriptions']
+  if affectedBy is not None :
+    imagesToBuild = cpb.moduleGraph.imagesAffectedBy(
+      config, imageDescs, imagesToBuild, affectedBy
+    )
+    if not imagesToBuild :
+      click.echo("\nNo images install the {} module\n".format(affectedBy))
+      return
   for anImage, aDesc in imageDescs.items() :
     if anImage == 'defaults' : continue
     if anImage not in imagesToBuild : continue
@@ -415,10 +953,12 @@ def images(ctx) :
     #print(yaml.dump(aDesc))
 
     print("\n{}:\t{}".format(aDesc['imageName'], aDesc['description']))
+    if aDesc.get('intermediate', False) :
+      print("    (a shared intermediate image which is not pushed)")
     print("    basedOn: {}".format(aDesc['basedOn']))
     print("    modules:")
     for aModule in aDesc['modules'] :
-      listSubModules("      ", aModule, config['modules'])
+      listSubModules("      ", aModule, config)
   print("")
   #print("-----------------------------------------------------")
   #print(yaml.dump(imageDescs))
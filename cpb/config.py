@@ -1,8 +1,257 @@
 # This python3 click subcommand lists the configuration of a cpb compute pod
 
 import click
+import logging
+import os
+import platform
+import sys
 import yaml
 
+from cpb.utils import *
+
+########################################################################
+# Handle configuration
+
+defaultConfig = {
+  'configYaml'              : "config.yaml",
+  'imageYaml'               : "image.yaml",
+  'cpfYaml'                 : "cpf.yaml",
+  'passwordsYaml'           : "passwords.yaml",
+  'serialsYaml'             : "serials.yaml",
+  'createManifestYaml'      : "createManifest.yaml",
+  'passwordLength'          : 16,
+  'cekitConfig'             : "cekit.ini",
+  'buildBaseDir'            : os.path.join("~", ".local", "computePods"),
+  'certificateAuthorityDir' : "certAuthority",
+  'podsDir'                 : "pods",
+  'natsDir'                 : "nats",
+  'usersDir'                : "users",
+  'strictTemplates'         : False,
+  'verbose'                 : False
+}
+
+defaultNatsDefaults = {
+  'hosts'                 : [],
+  'ports'                 : {  # NOTE: all ports must be mapped explicitly (or the external port will be chosen randomly)
+    'natsMsgs'            : '4222:4222',
+    #'natsRouting'        : '6222:6222',
+    #'natsMonitor'        : '8222:8222',
+  },
+  'volumes'               : [],
+  'envs'                  : {
+    'ENV' : '/root/.ashrc'
+  },
+  'shell'                 : '/bin/ash',
+  'secrets'               : [],
+  'images'                : [
+    'natsServer',
+  ],
+  'baseImages'            : [],
+  'maxLoadPerCPU'         : 2,
+  'cpus'                  : None,  # the number of cpus of the host (used by `auto` replicas)
+  'replicas'              : 1,     # the number of containers of each image (or `auto`)
+  'imageReplicas'         : {},    # (image specific) replicas
+  'resources'             : {},    # container resource limits (cpus, memory, cpusetCpus, pidsLimit, shmSize)
+  'imageResources'        : {},    # (image specific) resource limits
+  'topology'              : None,  # the host's cpus on each NUMA node (used by `auto` cpusetCpus)
+  'kubePlay'              : False
+}
+
+defaultMajorDomoDefaults = {
+  'hosts'                 : [],
+  'ports'                 : {  # NOTE: all ports must be mapped explicitly (or the external port will be chosen randomly)
+    'majorDomo'           : '127.0.0.1:8000:8000', # exposed ONLY on the local host
+  },
+  'volumes'               : [
+    '~/.local/cpmd:/cpmd',
+    '~/GitTools/computePods/interfaces/cpinterfaces:/cpinterfaces',
+    '~/GitTools/computePods/pythonUtils/cputils:/cputils',
+    '~/GitTools/computePods/majorDomo:/root/majorDomo'
+  ],
+  'envs'                  : {
+    'ENV' : '/root/.ashrc'
+  },
+  'shell'                 : '/bin/ash',
+  'secrets'               : [],
+  'images'                : [
+    'majorDomoServer',
+  ],
+  'baseImages'            : [],
+  'maxLoadPerCPU'         : 2,
+  'cpus'                  : None,  # the number of cpus of the host (used by `auto` replicas)
+  'replicas'              : 1,     # the number of containers of each image (or `auto`)
+  'imageReplicas'         : {},    # (image specific) replicas
+  'resources'             : {},    # container resource limits (cpus, memory, cpusetCpus, pidsLimit, shmSize)
+  'imageResources'        : {},    # (image specific) resource limits
+  'topology'              : None,  # the host's cpus on each NUMA node (used by `auto` cpusetCpus)
+  'kubePlay'              : False
+}
+
+defaultPodDefaults = {
+  'hosts'                 : [],
+  'ports'                 : {  # NOTE: all ports must be mapped explicitly (or the external port will be chosen randomly)
+  },
+  'volumes'               : [],
+  'envs'                  : {},
+  'shell'                 : '/bin/sh',
+  'secrets'               : [],
+  'images'                : [],
+  'baseImages'            : [],
+  'maxLoadPerCPU'         : 2,
+  'cpus'                  : None,  # the number of cpus of the host (used by `auto` replicas)
+  'replicas'              : 1,     # the number of containers of each image (or `auto`)
+  'imageReplicas'         : {},    # (image specific) replicas
+  'resources'             : {},    # container resource limits (cpus, memory, cpusetCpus, pidsLimit, shmSize)
+  'imageResources'        : {},    # (image specific) resource limits
+  'topology'              : None,  # the host's cpus on each NUMA node (used by `auto` cpusetCpus)
+  'kubePlay'              : False
+}
+
+def loadConfig(configPath, verbose):
+  # Start with the default configuration (above)
+  config = defaultConfig
+
+  # Add the global configuration (if any)
+  configPath = os.path.abspath(os.path.expanduser(configPath))
+  try:
+    globalConfigFile = open(configPath)
+    globalConfig = yamlLoad(globalConfigFile)
+    globalConfigFile.close()
+    if globalConfig is not None :
+      config.update(globalConfig)
+  except :
+    if verbose is not None and verbose :
+      print("INFO: no global configuration file found: [{}]".format(configPath))
+
+  # Now add in any local configuration
+  try:
+    localConfigFile = open(config['configYaml'], 'r')
+    localConfig = yamlLoad(localConfigFile)
+    localConfigFile.close()
+    if localConfig is not None :
+      config.update(localConfig)
+  except :
+    if verbose is not None and verbose :
+      print("INFO: no local configuration file found: [{}]".format(config['configYaml']))
+
+  # Now add in command line argument/options
+  if verbose is not None :
+    config['verbose'] = verbose
+  if configPath is not None :
+    config['configPath'] = configPath
+  else:
+    print("ERROR: a configPath must be specified!")
+    sys.exit(-1)
+
+  # Now sanitize any known configurable paths
+  sanitizeFilePath(config, 'configPath', None)
+  config['configDir'] = os.path.dirname(configPath)
+  sanitizeFilePath(config, 'cekitConfig', config['configDir'])
+
+  sanitizeFilePath(config, 'imageYaml', None)
+  sanitizeFilePath(config, 'cpfYaml', None)
+  config['curDir'] = os.path.abspath(os.getcwd())
+  config['homeDir'] = os.path.expanduser("~")
+
+  # Now add in platform parameters
+  thePlatform = {}
+  thePlatform['system']    = platform.system()
+  thePlatform['node']      = platform.node()
+  thePlatform['release']   = platform.release()
+  thePlatform['version']   = platform.version()
+  thePlatform['machine']   = platform.machine()
+  thePlatform['processor'] = platform.processor()
+  config['platform']       = thePlatform
+
+  # Setup logging
+  if config['verbose'] :
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.DEBUG)
+  else:
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+
+  return config
+
+# Load the configuration (once) for the subcommand being run (the cli
+# group only records the --config and --verbose options in ctx.obj)
+#
+def getConfig(ctx) :
+  if 'config' not in ctx.obj :
+    ctx.obj['config'] = loadConfig(ctx.obj['configFile'], ctx.obj['verbose'])
+  return ctx.obj['config']
+
+# Load the federation's passwords and compute pod federation (cpf)
+# descriptions. (This is only done by the commands which need them, and
+# only when their normalized configuration is not cached, see
+# cpb.configCache)
+#
+def loadFederation(config) :
+  verbose = config['verbose']
+
+  # Now add in the passwords.yaml (if it exists)
+  config['passwords'] = {
+    'ca'    : {},
+    'pods'  : {},
+    'nats'  : {},
+    'users' : {}
+  }
+  try:
+    passwordsFile = open(config['passwordsYaml'], 'r')
+    passwords = yamlLoad(passwordsFile)
+    passwordsFile.close()
+    if passwords is not None :
+      if 'ca' not in passwords :
+        passwords['ca'] = {}
+      if 'pods' not in passwords :
+        passwords['pods'] = {}
+      if 'nats' not in passwords :
+        passwords['nats'] = {}
+      if 'users' not in passwords :
+        passwords['users'] = {}
+      config['passwords'] = passwords
+  except IOError :
+    if verbose is not None and verbose :
+      print("INFO: could not load the passwords file: [{}]".format(config['passwordsYaml']))
+  except Exception as e :
+    if verbose is not None and verbose :
+      print("INFO: could not load the passwords file: [{}]".format(config['passwordsYaml']))
+      print("\t" + "\n\t".join(str(e).split('\n')))
+
+
+  # Now add in the cpb.yaml (if it exists)
+  config['cpf'] = {}
+  try:
+    cpfFile = open(config['cpfYaml'], 'r')
+    cpf = yamlLoad(cpfFile)
+    cpfFile.close()
+    if cpf is not None :
+      config['cpf'] = cpf
+  except IOError :
+    if verbose is not None and verbose :
+      print("INFO: could not load the cpf file: [{}]".format(config['cpfYaml']))
+  except Exception as e :
+    if verbose is not None and verbose :
+      print("INFO: could not load the cpf file: [{}]".format(config['cpfYaml']))
+      print("\t" + "\n\t".join(str(e).split('\n')))
+  podDefaults = {}
+  if 'podDefaults' in config['cpf'] :
+    podDefaults = config['cpf']['podDefaults']
+  mergePodDefaults(podDefaults, defaultPodDefaults)
+  config['cpf']['podDefaults']  = podDefaults
+
+  natsDefaults = {}
+  if 'natsDefaults' in config['cpf'] :
+    natsDefaults = config['cpf']['natsDefaults']
+  mergePodDefaults(natsDefaults, defaultNatsDefaults)
+  config['cpf']['natsDefaults'] = natsDefaults
+
+  majorDomoDefaults = {}
+  if 'majorDomoDefaults' in config['cpf'] :
+    majorDomoDefaults = config['cpf']['majorDomoDefaults']
+  mergePodDefaults(majorDomoDefaults, defaultMajorDomoDefaults)
+  config['cpf']['majorDomoDefaults'] = majorDomoDefaults
+
+  return config
+
 def normalizeConfig(config) :
   pass
 
@@ -19,7 +268,9 @@ def config(ctx):
   configuration parameters you might like to specify.
   """
 
-  print("configuration:\n------\n" + yaml.dump(ctx.obj) + "------\n")
+  config = getConfig(ctx)
+  loadFederation(config)
+  print("configuration:\n------\n" + yaml.dump(config) + "------\n")
 
   click.echo("""
 The following configuration options can be specified in the global YAML
@@ -53,6 +304,11 @@ cekitConfig:
     If this option does not begin with a '/', then it assumed to be a path
     relative to the configPath directory.
 
+strictTemplates:
+
+    A boolean which specifies if rendering a template which uses an
+    undefined value should fail (rather than render an empty string).
+
 verbose: (-v, --verbose)
 
     A boolean which specifies if additional working details should be
@@ -0,0 +1,145 @@
+# This python module caches the normalized configuration used by each
+# family of cpb subcommands (build/images and create/pods/users).
+#
+# Normalizing the configuration requires loading (and parsing) the
+# passwords.yaml and cpf.yaml files, as well as (for the build family)
+# every module.yaml in every cekit module repository. The normalized
+# configuration is cached (in the `configCache` directory of the
+# `buildBaseDir`) together with the SHA256 hashes of all of these input
+# files (as well as of the cpb package itself). The cache is only used if
+# none of these hashes has changed.
+
+import hashlib
+import logging
+import os
+import pickle
+
+import cpb.config
+import cpb.trace
+
+cacheVersion = 2
+
+def hashInputFile(filePath) :
+  try :
+    with open(filePath, 'rb') as inputFile :
+      return hashlib.sha256(inputFile.read()).hexdigest()
+  except IOError :
+    return None
+
+def listInputDir(dirPath) :
+  try :
+    return sorted(os.listdir(dirPath))
+  except OSError :
+    return None
+
+# The cpb package is an input to the normalized configuration (since it
+# contains the default configuration and the bundled cekit modules)
+#
+def packageFiles() :
+  packageDir = os.path.dirname(os.path.abspath(cpb.config.__file__))
+  someFiles = []
+  for aRoot, someDirs, someFileNames in os.walk(packageDir) :
+    someDirs[:] = sorted(aDir for aDir in someDirs if aDir != '__pycache__')
+    for aFileName in sorted(someFileNames) :
+      someFiles.append(os.path.join(aRoot, aFileName))
+  return someFiles
+
+def configInputFiles(config) :
+  return [
+    config['configPath'],
+    os.path.abspath(config['configYaml']),
+    os.path.abspath(config['cpfYaml']),
+    os.path.abspath(config['passwordsYaml']),
+    os.path.abspath(config['serialsYaml']),
+  ] + packageFiles()
+
+def cacheFilePath(config, family) :
+  cacheKey = hashlib.sha256("{}\n{}\n{}".format(
+    config['curDir'], os.path.abspath(config['cpfYaml']), config['verbose']
+  ).encode()).hexdigest()[:16]
+  return os.path.join(
+    os.path.abspath(os.path.expanduser(config['buildBaseDir'])),
+    'configCache', "{}-{}.pickle".format(family, cacheKey)
+  )
+
+def loadCachedConfig(cachePath, config) :
+  try :
+    # (caches saved by older versions of cpb could be read by anyone)
+    os.chmod(cachePath, 0o600)
+    with open(cachePath, 'rb') as cacheFile :
+      cacheEntry = pickle.load(cacheFile)
+  except Exception :
+    return None
+
+  if cacheEntry.get('version', None) != cacheVersion :
+    return None
+  for aFile in configInputFiles(config) :
+    if aFile not in cacheEntry['inputFiles'] :
+      return None
+  for aFile, aHash in cacheEntry['inputFiles'].items() :
+    if hashInputFile(aFile) != aHash :
+      logging.info("config cache: {} has changed".format(aFile))
+      return None
+  for aDir, aListing in cacheEntry['inputDirs'].items() :
+    if listInputDir(aDir) != aListing :
+      logging.info("config cache: {} has changed".format(aDir))
+      return None
+  return cacheEntry['config']
+
+def saveCachedConfig(cachePath, config, inputFiles, inputDirs) :
+  cacheEntry = {
+    'version'    : cacheVersion,
+    'inputFiles' : { aFile : hashInputFile(aFile) for aFile in inputFiles },
+    'inputDirs'  : { aDir  : listInputDir(aDir)   for aDir  in inputDirs  },
+    'config'     : config
+  }
+  try :
+    # (the normalized configuration contains the federation's passwords,
+    # so, like the passwords.yaml file, only the user can read the cache)
+    cacheDir = os.path.dirname(cachePath)
+    os.makedirs(cacheDir, mode=0o700, exist_ok=True)
+    os.chmod(cacheDir, 0o700)
+    tmpPath = cachePath + '.tmp-{}'.format(os.getpid())
+    tmpFd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(tmpFd, 0o600)
+    with os.fdopen(tmpFd, 'wb') as cacheFile :
+      pickle.dump(cacheEntry, cacheFile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpPath, cachePath)
+  except Exception as err :
+    logging.info("Could not save the config cache [{}]: {}".format(cachePath, repr(err)))
+
+# Return the normalized configuration for the `family` of subcommands,
+# either from the cache, or by loading the federation's description and
+# then using the `normalizeConfig` function.
+#
+# The (optional) `extraInputs` function is given the normalized
+# configuration, and returns any additional input files and directories
+# used by `normalizeConfig`.
+#
+# The returned configuration has `fromConfigCache` set to True if it came
+# from the cache.
+#
+def normalizeWithCache(config, family, normalizeConfig, extraInputs=None) :
+  cachePath = cacheFilePath(config, family)
+  inputFiles = configInputFiles(config)
+
+  with cpb.trace.phase('loadConfigCache', family=family) :
+    cachedConfig = loadCachedConfig(cachePath, config)
+  if cachedConfig is not None :
+    logging.info("using the cached {} configuration".format(family))
+    cachedConfig['fromConfigCache'] = True
+    return cachedConfig
+
+  with cpb.trace.phase('loadFederation') :
+    cpb.config.loadFederation(config)
+  with cpb.trace.phase('normalizeConfig', family=family) :
+    normalizeConfig(config)
+
+  inputDirs = []
+  if extraInputs is not None :
+    extraFiles, inputDirs = extraInputs(config)
+    inputFiles = inputFiles + extraFiles
+  with cpb.trace.phase('saveConfigCache', family=family) :
+    saveCachedConfig(cachePath, config, inputFiles, inputDirs)
+  config['fromConfigCache'] = False
+  return config
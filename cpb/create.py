@@ -2,15 +2,22 @@
 # used by subsequence subcommands.
 
 import click
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
 import datetime
+import hashlib
 import importlib.resources
-import jinja2
+import io
+import ipaddress
+import json
 import logging
+import math
 import os
 import random
 import shutil
 import stat
 import string
+import subprocess
 import sys
 import time
 import yaml
@@ -41,9 +48,17 @@ from pymakeself import makeself
 #    Return:
 #    Path to self-extracting installer executable.
 
+import cpb.config
+import cpb.configCache
+import cpb.nativeCrypto
+import cpb.placement
+import cpb.scheduler
+import cpb.templates
+import cpb.trace
 from cpb.utils import *
 
-# We use openssl and ssh-keygen from the command line...
+# We use openssl and ssh-keygen from the command line (unless the python
+# cryptography package is available, see cpb.nativeCrypto)...
 #
 # See: https://www.openssl.org/docs/manmaster/man5/x509v3_config.html
 # see: https://stackoverflow.com/questions/10175812/how-to-create-a-self-signed-certificate-with-openssl
@@ -62,46 +77,143 @@ from cpb.utils import *
 ############################################################################
 # Configuration
 
+# The types of keys which can be used by the certificate authority, pods,
+# users and the rsync ssh key (as command line arguments for `openssl
+# genpkey` and `ssh-keygen`).
+#
+keyTypes = {
+  'rsa' : {
+    'genpkey'   : "-algorithm RSA -pkeyopt rsa_keygen_bits:{keySize}",
+    'sshKeygen' : "-t rsa -b {keySize}",
+  },
+  'ecdsa-p256' : {
+    'genpkey'   : "-algorithm EC -pkeyopt ec_paramgen_curve:P-256 -pkeyopt ec_param_enc:named_curve",
+    'sshKeygen' : "-t ecdsa -b 256",
+  },
+  'ecdsa-p384' : {
+    'genpkey'   : "-algorithm EC -pkeyopt ec_paramgen_curve:P-384 -pkeyopt ec_param_enc:named_curve",
+    'sshKeygen' : "-t ecdsa -b 384",
+  },
+  'ed25519' : {
+    'genpkey'   : "-algorithm ED25519",
+    'sshKeygen' : "-t ed25519",
+  },
+}
+
+def checkKeyType(eData) :
+  if eData['keyType'] not in keyTypes :
+    logging.error("Unknown keyType [{}] for {} (must be one of: {})".format(
+      eData['keyType'], eData['name'], ", ".join(keyTypes.keys())
+    ))
+    sys.exit(-1)
+
 def generateNewPassword(passwords, eData, config) :
   passwordCharacters = string.ascii_letters + string.digits
   randomPassword =  "".join(random.choice(passwordCharacters) for x in range(config['passwordLength']))
   setDefault(passwords, eData['name'], randomPassword)
   eData['password'] = passwords[eData['name']]
 
+############################################################################
+# Serial numbers
+#
+# Each certificate's serial number is allocated (once) from a persistent
+# registry (the serials.yaml file, next to the passwords.yaml file), so
+# that each certificate authority, pod and user keeps the same serial
+# number however the federation's description is (re)ordered or grows.
+#
+# New serial numbers are allocated from a counter which starts at the
+# time the registry was created (multiplied by 10,000, so that serial
+# numbers allocated by older versions of cpb are not reused) and has no
+# upper limit.
+
+# The kind of each entity (which keys both its serial number and its
+# password)
+#
+entityKinds = {
+  'certificateAuthorityDir' : 'ca',
+  'podsDir'                 : 'pods',
+  'natsDir'                 : 'nats',
+  'usersDir'                : 'users'
+}
+
+def loadSerials(config) :
+  serials = None
+  try :
+    with open(config['serialsYaml'], 'r') as serialsFile :
+      serials = yamlLoad(serialsFile)
+  except IOError :
+    logging.info("could not load the serials file: [{}]".format(config['serialsYaml']))
+  if serials is None :
+    serials = {}
+  setDefault(serials, 'nextSerial', int(time.time()) * 10000)
+  for aKind in entityKinds.values() :
+    if aKind not in serials or serials[aKind] is None :
+      serials[aKind] = {}
+  config['serials'] = serials
+
+def saveSerials(config) :
+  serialsYaml = yaml.dump(config['serials'])
+  try :
+    with open(config['serialsYaml'], 'r') as serialsFile :
+      if serialsFile.read() == serialsYaml :
+        return
+  except IOError :
+    pass
+  with open(config['serialsYaml'], 'w') as serialsFile :
+    serialsFile.write(serialsYaml)
+
+def allocateSerial(config, workDirKey, eName) :
+  serials = config['serials']
+  kindSerials = serials[entityKinds[workDirKey]]
+  if eName not in kindSerials :
+    kindSerials[eName] = serials['nextSerial']
+    serials['nextSerial'] += 1
+  return kindSerials[eName]
+
 def normalizeSshEntity(config, eData, workDirKey) :
   setDefault(eData, 'name', config['federationName']+'-rsync')
   timeNow = datetime.datetime.now().strftime("%Y.%m.%d-%H.%M.%S")
   setDefault(eData, 'comment',  timeNow+'-'+eData['name'])
   eData['workDir'] = config[workDirKey]
-  setDefault(eData, 'keyFile', eData['name'] + '-rsa')
+  setDefault(eData, 'keyType', config['cpf']['keyType'])
+  checkKeyType(eData)
+  setDefault(eData, 'keyFile', eData['name'] + '-' + eData['keyType'].split('-')[0])
   sanitizeFilePath(eData, 'keyFile', eData['workDir'])
   setDefault(eData, 'keySize', config['cpf']['keySize'])
   generateNewPassword(config['passwords']['ca'], eData, config)
 
-def normalizeSslEntity(config, eData, eNum, workDirKey, caData, podDefaults) :
-  passwords = config['passwords']['ca']
+def nameSslEntity(eData, workDirKey) :
   if workDirKey == 'certificateAuthorityDir' :
     if 'federationName' not in eData :
       logging.error("All certificate authorities MUST have a 'federationName' key")
       sys.exit(-1)
-    passwords = config['passwords']['ca']
     eData['name'] = eData['federationName'] + '-ca'
   if workDirKey == 'podsDir' :
     if 'host' not in eData :
       logging.error("All pods MUST have a 'host' key")
       sys.exit(-1)
-    passwords = config['passwords']['pods']
     eData['name'] = eData['host'].split(',')[0]
   if workDirKey == 'natsDir' :
-    eData['name'] = 'nats'
-    passwords = config['passwords']['nats']
+    setDefault(eData, 'name', 'nats')
   if workDirKey == 'usersDir' :
     if 'name' not in eData :
       logging.error("All users MUST have a 'name' key")
       sys.exit(-1)
-    passwords = config['passwords']['users']
-
   eData['name'] = eData['name'].replace("@", "-")
+
+# Allocate (once) the serial number and password of an entity, without
+# normalizing (or changing) the entity's description
+#
+def reserveSslEntity(config, eData, workDirKey) :
+  eData = dict(eData)
+  nameSslEntity(eData, workDirKey)
+  if 'serialNum' not in eData :
+    allocateSerial(config, workDirKey, eData['name'])
+  generateNewPassword(config['passwords'][entityKinds[workDirKey]], eData, config)
+
+def normalizeSslEntity(config, eData, workDirKey, caData, podDefaults) :
+  passwords = config['passwords'][entityKinds[workDirKey]]
+  nameSslEntity(eData, workDirKey)
   eData['workDir'] = os.path.join(config[workDirKey], eData['name'].replace(" ",""))
   eData['configDir'] = os.path.join(eData['workDir'], 'config')
 
@@ -120,6 +232,8 @@ def normalizeSslEntity(config, eData, eNum, workDirKey, caData, podDefaults) :
   setDefault(eData, 'makeSelfFile', '../install-' + eData['name'] + '-pod.run')
   sanitizeFilePath(eData, 'makeSelfFile', eData['workDir'])
 
+  setDefault(eData, 'keyType',        config['cpf']['keyType'])
+  checkKeyType(eData)
   setDefault(eData, 'keySize',        config['cpf']['keySize'])
   setDefault(eData, 'days',           caData['days'])
   setDefault(eData, 'country',        caData['country'])
@@ -127,7 +241,9 @@ def normalizeSslEntity(config, eData, eNum, workDirKey, caData, podDefaults) :
   setDefault(eData, 'locality',       caData['locality'])
   setDefault(eData, 'organization',   caData['organization'])
   setDefault(eData, 'federationName', caData['federationName'])
-  setDefault(eData, 'serialNum',      caData['serialNum']+eNum)
+  if 'serialNum' not in eData :
+    eData['serialNum'] = allocateSerial(config, workDirKey, eData['name'])
+  setDefault(eData, 'cryptoBackend',  config['cryptoBackend'])
 
   generateNewPassword(passwords, eData, config)
 
@@ -159,10 +275,439 @@ def normalizeSslEntity(config, eData, eNum, workDirKey, caData, podDefaults) :
       innerPorts[aKey] = aValue.split(':')[-1]
     eData['innerPorts'] = innerPorts
 
-    eData['natsServer'] = config['cpf']['natsServer']
+    normalizeContainers(eData)
+    normalizeResources(eData)
+    normalizeKubePod(eData)
+
+    eData['natsServers'] = natsServersFor(config, eData)
+    eData['natsServer']  = eData['natsServers'][0]
 
     eData['rsyncPublicKeyFile'] = os.path.basename(config['cpf']['rsync']['keyFile']) + '.pub'
 
+############################################################################
+# NATS servers
+#
+# The federation can have one NATS server:
+#
+#   natsServer:
+#     host: nats01
+#     port: 4222
+#
+# or a cluster of NATS servers, either listed:
+#
+#   natsServers:
+#     - host: nats01
+#     - host: nats02
+#       port: 4223
+#       clusterPort: 6223
+#
+# or as a count of servers assigned (in turn) to some hosts:
+#
+#   natsServers:
+#     count: 4
+#     hosts: [ nats01, nats02 ]
+#
+# (servers which share a host are given the next free client and cluster
+# ports). Each server has its own pod. The servers of a cluster connect
+# to each other using routes (secured using TLS certificates signed by the
+# federation's certificate authority), and can be tuned using:
+#
+#   natsCluster:
+#     name: aClusterName
+#     maxPayload: 8MB
+#     writeDeadline: 10s
+#     maxPending: 64MB
+#
+# Every chef and MajorDomo is given the list of all of the servers, in an
+# order rotated (by a hash of its name) so that the connections are
+# spread across the cluster.
+
+defaultNatsPort        = 4222
+defaultNatsClusterPort = 6222
+
+defaultNatsCluster = {
+  'maxPayload'    : '8MB',
+  'writeDeadline' : '10s',
+  'maxPending'    : '64MB'
+}
+
+def listNatsServers(cpf) :
+  if 'natsServers' in cpf :
+    natsServers = cpf['natsServers']
+    if isinstance(natsServers, dict) :
+      hosts = natsServers.get('hosts', None) or []
+      if not hosts :
+        logging.error("A count of NATS servers MUST provide some 'hosts'")
+        sys.exit(-1)
+      count = natsServers.get('count', len(hosts))
+      return [ { 'host' : hosts[serverNum % len(hosts)] } for serverNum in range(count) ]
+    return [ dict(aServer) for aServer in natsServers or [] ]
+  if 'natsServer' in cpf :
+    return [ dict(cpf['natsServer']) ]
+  return []
+
+def normalizeNatsServers(config) :
+  cpf = config['cpf']
+  natsServers = listNatsServers(cpf)
+  if not natsServers :
+    logging.error("A compute pod federation MUST provide a natsServer (or natsServers)")
+    sys.exit(-1)
+
+  serversPerHost = {}
+  for serverNum, aServer in enumerate(natsServers) :
+    if 'host' not in aServer :
+      logging.error("All NATS servers MUST have a 'host' key")
+      sys.exit(-1)
+    hostNames = [ aHost.strip() for aHost in str(aServer['host']).split(',') ]
+    onHost = serversPerHost.get(hostNames[0], 0)
+    serversPerHost[hostNames[0]] = onHost + 1
+    aServer['hostNames']   = str(aServer['host'])
+    aServer['host']        = hostNames[0]
+    aServer['altNames']    = hostNames
+    aServer.setdefault('port',        defaultNatsPort + onHost)
+    aServer.setdefault('clusterPort', defaultNatsClusterPort + onHost)
+    if len(natsServers) == 1 :
+      aServer['name']    = 'nats'
+      aServer['podName'] = "{}-natsServer".format(config['federationName'])
+    else :
+      aServer['name']    = 'nats-{}'.format(serverNum + 1)
+      aServer['podName'] = "{}-natsServer-{}".format(config['federationName'], serverNum + 1)
+
+  # each NATS server publishes its port (and, when clustered, its cluster
+  # port) on its host, so these MUST not clash on any one host
+  usedPorts = {}
+  for aServer in natsServers :
+    serverPorts = [ ('port', aServer['port']) ]
+    if 1 < len(natsServers) :
+      serverPorts.append(('clusterPort', aServer['clusterPort']))
+    for aPortName, aPort in serverPorts :
+      hostPort = (aServer['host'], int(aPort))
+      if hostPort in usedPorts :
+        logging.error("The {} of the {} NATS server clashes with the {} of the {} NATS server (both use port {} on {})".format(
+          aPortName, aServer['name'], usedPorts[hostPort][0], usedPorts[hostPort][1],
+          aPort, aServer['host']
+        ))
+        sys.exit(-1)
+      usedPorts[hostPort] = (aPortName, aServer['name'])
+
+  natsCluster = dict(defaultNatsCluster)
+  natsCluster['name'] = "{}-nats".format(config['federationName'])
+  natsCluster.update(cpf.get('natsCluster', None) or {})
+
+  cpf['natsServers'] = natsServers
+  cpf['natsServer']  = natsServers[0]
+  cpf['natsCluster'] = natsCluster
+
+# The NATS servers in the order (rotated by a hash of the name of the pod
+# or user) in which they should be used
+#
+def natsServersFor(config, eData) :
+  natsServers = config['cpf']['natsServers']
+  rotation = int(hashlib.sha256(eData['name'].encode()).hexdigest(), 16) % len(natsServers)
+  return natsServers[rotation:] + natsServers[:rotation]
+
+def natsPodFor(config, aServer) :
+  return {
+    'host'     : aServer['hostNames'],
+    'name'     : aServer['name'],
+    'podName'  : aServer['podName'],
+    'images'   : [ ],
+    'ports'    : natsPorts(config, aServer),
+    'altNames' : aServer['altNames']
+  }
+
+def natsPorts(config, aServer) :
+  ports = { 'natsMsgs' : "{}:{}".format(aServer['port'], aServer['port']) }
+  if 1 < len(config['cpf']['natsServers']) :
+    ports['natsRouting'] = "{}:{}".format(aServer['clusterPort'], aServer['clusterPort'])
+  return ports
+
+def normalizeNatsPod(config, natsPod, aServer, caData) :
+  natsPod['natsSelf']    = aServer
+  natsPod['natsCluster'] = config['cpf']['natsCluster']
+  natsPod['natsRoutes']  = [
+    aRoute for aRoute in config['cpf']['natsServers'] if aRoute is not aServer
+  ]
+  if natsPod['natsRoutes'] :
+    natsPod['natsTls'] = {
+      'certFile' : os.path.join('/config', os.path.basename(natsPod['certFile'])),
+      'keyFile'  : os.path.join('/config', os.path.basename(natsPod['keyFile'])),
+      'caFile'   : os.path.join('/config', os.path.basename(caData['certFile']))
+    }
+
+############################################################################
+# Replicas
+#
+# Each pod runs `replicas` containers of each of its images (unless the
+# image is given its own number of replicas in the pod's `imageReplicas`).
+#
+# The number of replicas can be `auto`, in which case it is the number of
+# the host's `cpus` (declared in the pod's description) multiplied by the
+# pod's `maxLoadPerCPU` (but at least one).
+#
+# Images with one replica have one container named after the image.
+# Images with more than one replica have containers named
+# `<<image>>-1`, `<<image>>-2`, ...
+
+def resolveReplicas(eData, anImage) :
+  replicas = eData['imageReplicas'].get(anImage, eData['replicas'])
+  if replicas == 'auto' :
+    if not eData['cpus'] :
+      logging.error("The {} pod MUST declare its 'cpus' to use auto replicas (for the {} image)".format(
+        eData['name'], anImage
+      ))
+      sys.exit(-1)
+    replicas = max(1, int(eData['cpus'] * eData['maxLoadPerCPU']))
+  if not isinstance(replicas, int) or replicas < 1 :
+    logging.error("The replicas of the {} image in the {} pod MUST be a positive integer or 'auto' (not [{}])".format(
+      anImage, eData['name'], replicas
+    ))
+    sys.exit(-1)
+  return replicas
+
+def normalizeContainers(eData) :
+  # an image may be listed by both the pod and its defaults
+  eData['images'] = list(dict.fromkeys(eData['images']))
+
+  containers = []
+  for anImage in eData['images'] :
+    replicas = resolveReplicas(eData, anImage)
+    for aReplica in range(1, replicas+1) :
+      containerName = anImage
+      if 1 < replicas :
+        containerName = "{}-{}".format(anImage, aReplica)
+      containers.append({
+        'name'     : containerName,
+        'image'    : anImage,
+        'replica'  : aReplica,
+        'replicas' : replicas
+      })
+  containerNames = [ aContainer['name'] for aContainer in containers ]
+  for aContainerName in containerNames :
+    if 1 < containerNames.count(aContainerName) :
+      logging.error("The {} pod has more than one {} container (rename an image?)".format(
+        eData['name'], aContainerName
+      ))
+      sys.exit(-1)
+  eData['containers'] = containers
+
+############################################################################
+# Resource profiles
+#
+# Each container's resource limits are the pod's `resources` overridden by
+# any of the image's `imageResources`:
+#
+#   cpus       : the number of cpus            (podman --cpus)
+#   memory     : the memory limit (e.g. 512m)  (podman --memory)
+#   cpusetCpus : the cpus to use (e.g. 0-3,8)  (podman --cpuset-cpus)
+#   pidsLimit  : the maximum number of pids    (podman --pids-limit)
+#   shmSize    : the size of /dev/shm          (podman --shm-size)
+#
+# A `cpusetCpus` of `auto` assigns each such container its own (disjoint)
+# set of cpus taken from the pod's `topology`, for example:
+#
+#   topology:
+#     numaNodes:
+#       - 0-15
+#       - 16-31
+#
+# (if no topology is given, the pod's `cpus` are used as one NUMA node).
+# Each container gets `cpus` (rounded up) cpus, or an equal share of the
+# cpus, which are taken from one NUMA node whenever possible.
+
+resourceKeys = [ 'cpus', 'memory', 'cpusetCpus', 'pidsLimit', 'shmSize' ]
+
+def parseCpuList(aCpuList) :
+  someCpus = []
+  for aRange in str(aCpuList).split(',') :
+    aRange = aRange.strip()
+    if not aRange : continue
+    if '-' in aRange :
+      first, last = aRange.split('-', 1)
+      someCpus.extend(range(int(first), int(last)+1))
+    else :
+      someCpus.append(int(aRange))
+  return someCpus
+
+def formatCpuList(someCpus) :
+  ranges = []
+  for aCpu in sorted(someCpus) :
+    if ranges and ranges[-1][1] == aCpu - 1 :
+      ranges[-1][1] = aCpu
+    else :
+      ranges.append([aCpu, aCpu])
+  return ",".join(
+    str(first) if first == last else "{}-{}".format(first, last)
+      for first, last in ranges
+  )
+
+def checkResources(eData, someResources, aWhere) :
+  for aKey in someResources :
+    if aKey not in resourceKeys :
+      logging.error("Unknown resource [{}] in the {} of the {} pod (must be one of: {})".format(
+        aKey, aWhere, eData['name'], ", ".join(resourceKeys)
+      ))
+      sys.exit(-1)
+
+def numaNodesOf(eData) :
+  topology = eData['topology']
+  if topology and topology.get('numaNodes', None) :
+    return [ parseCpuList(aNode) for aNode in topology['numaNodes'] ]
+  if eData['cpus'] :
+    return [ list(range(int(eData['cpus']))) ]
+  logging.error("The {} pod MUST declare its 'topology' (or 'cpus') to use auto cpusetCpus".format(
+    eData['name']
+  ))
+  sys.exit(-1)
+
+def assignCpusets(eData, autoContainers, usedCpus) :
+  # (cpus which have been explicitly assigned are not shared)
+  numaNodes = [
+    [ aCpu for aCpu in aNode if aCpu not in usedCpus ]
+      for aNode in numaNodesOf(eData)
+  ]
+  numCpus = sum(len(aNode) for aNode in numaNodes)
+  shareCpus = max(1, numCpus // len(autoContainers))
+  for aContainer in autoContainers :
+    wantedCpus = shareCpus
+    if 'cpus' in aContainer['resources'] :
+      wantedCpus = max(1, math.ceil(float(aContainer['resources']['cpus'])))
+    someCpus = None
+    for aNode in numaNodes :
+      if wantedCpus <= len(aNode) :
+        someCpus = aNode[:wantedCpus]
+        del aNode[:wantedCpus]
+        break
+    if someCpus is None :
+      # spread the cpus across the NUMA nodes
+      freeCpus = [ aCpu for aNode in numaNodes for aCpu in aNode ]
+      if len(freeCpus) < wantedCpus :
+        logging.error("The {} pod does not have enough cpus to assign {} cpus to the {} container".format(
+          eData['name'], wantedCpus, aContainer['name']
+        ))
+        sys.exit(-1)
+      someCpus = freeCpus[:wantedCpus]
+      for aNode in numaNodes :
+        aNode[:] = [ aCpu for aCpu in aNode if aCpu not in someCpus ]
+    aContainer['resources']['cpusetCpus'] = formatCpuList(someCpus)
+
+def normalizeResources(eData) :
+  checkResources(eData, eData['resources'], 'resources')
+  autoContainers = []
+  usedCpus = set()
+  for aContainer in eData['containers'] :
+    imageResources = eData['imageResources'].get(aContainer['image'], None) or {}
+    checkResources(eData, imageResources, "imageResources of the {} image".format(aContainer['image']))
+    someResources = {}
+    someResources.update(eData['resources'])
+    someResources.update(imageResources)
+    aContainer['resources'] = {
+      aKey : aValue for aKey, aValue in someResources.items() if aValue is not None
+    }
+    cpusetCpus = aContainer['resources'].get('cpusetCpus', None)
+    if cpusetCpus == 'auto' :
+      autoContainers.append(aContainer)
+    elif cpusetCpus is not None :
+      usedCpus.update(parseCpuList(cpusetCpus))
+  if autoContainers :
+    assignCpusets(eData, autoContainers, usedCpus)
+
+############################################################################
+# Kubernetes (style) pod descriptions
+#
+# Each pod is also described as a Kubernetes pod (see the podKube.yaml.j2
+# template), so that (if the `kubePlay` pod option is set) the pod and all
+# of its containers can be created using one `podman kube play` call.
+#
+# Relative host paths are made relative to the __POD_DIR__ placeholder,
+# which the pod's scripts replace with the directory they are run in.
+
+kubePodDir = '__POD_DIR__'
+
+def kubePort(aPortName, aPortDef) :
+  protocol = 'TCP'
+  if '/' in aPortDef :
+    aPortDef, protocol = aPortDef.split('/', 1)
+  parts = aPortDef.rsplit(':', 2)
+  aPort = {
+    'name'          : aPortName.lower(),
+    'containerPort' : int(parts[-1]),
+    'protocol'      : protocol.upper()
+  }
+  if 1 < len(parts) and parts[-2] :
+    aPort['hostPort'] = int(parts[-2])
+  if 2 < len(parts) and parts[0] :
+    aPort['hostIP'] = parts[0].strip('[]')
+  return aPort
+
+def kubeHostAliases(someHosts) :
+  hostAliases = {}
+  for aHost in someHosts :
+    hostName, hostIP = aHost.split(':', 1)
+    hostAliases.setdefault(hostIP, [])
+    hostAliases[hostIP].append(hostName)
+  return [
+    { 'ip' : hostIP, 'hostnames' : hostNames }
+      for hostIP, hostNames in hostAliases.items()
+  ]
+
+def kubeVolume(aVolumeName, aVolumeDef) :
+  parts = aVolumeDef.split(':')
+  aVolume = {
+    'name'      : aVolumeName,
+    'mountPath' : parts[1] if 1 < len(parts) else parts[0],
+    'readOnly'  : 2 < len(parts) and 'ro' in parts[2].split(',')
+  }
+  hostPath = parts[0]
+  if len(parts) < 2 :
+    # an anonymous volume
+    aVolume['emptyDir'] = True
+  elif hostPath.startswith('/') :
+    aVolume['hostPath'] = hostPath
+  elif hostPath.startswith('.') or '/' in hostPath :
+    aVolume['hostPath'] = os.path.normpath(os.path.join(kubePodDir, hostPath))
+  else :
+    # a named podman volume
+    aVolume['claimName'] = hostPath
+  return aVolume
+
+# Convert a podman memory size (e.g. 512m) to a Kubernetes quantity
+#
+def kubeMemory(aMemorySize) :
+  aMemorySize = str(aMemorySize).strip().lower()
+  if aMemorySize.endswith('b') :
+    aMemorySize = aMemorySize[:-1]
+  units = { 'k' : 'Ki', 'm' : 'Mi', 'g' : 'Gi', 't' : 'Ti' }
+  if aMemorySize and aMemorySize[-1] in units :
+    return aMemorySize[:-1] + units[aMemorySize[-1]]
+  return aMemorySize
+
+# (cpusetCpus, pidsLimit and shmSize can not be described in a Kubernetes
+# pod, and are only used by the `podman container create` scripts)
+#
+def kubeLimits(someResources) :
+  limits = {}
+  if 'cpus' in someResources :
+    limits['cpu'] = str(someResources['cpus'])
+  if 'memory' in someResources :
+    limits['memory'] = kubeMemory(someResources['memory'])
+  return limits
+
+def normalizeKubePod(eData) :
+  eData['kubePorts'] = [
+    kubePort(aPortName, aPortDef)
+      for aPortName, aPortDef in eData['ports'].items()
+  ]
+  eData['kubeHostAliases'] = kubeHostAliases(eData['hosts'])
+  someVolumes = [ './config:/config:ro', './commons:/commons' ] + eData['volumes']
+  eData['kubeVolumes'] = [
+    kubeVolume('volume-{}'.format(volumeNum), aVolumeDef)
+      for volumeNum, aVolumeDef in enumerate(someVolumes)
+  ]
+  for aContainer in eData['containers'] :
+    aContainer['kubeLimits'] = kubeLimits(aContainer['resources'])
+  eData['kubePodDir'] = kubePodDir
+
 def normalizeConfig(config) :
 
   if 'cpf' not in config :
@@ -182,6 +727,15 @@ def normalizeConfig(config) :
   caData = config['cpf']['certificateAuthority']
   caData['federationName'] = config['cpf']['federationName']
 
+  setDefault(config['cpf'], 'keyType', 'rsa')
+  setDefault(config['cpf'], 'keySize', 4096)
+
+  normalizePackaging(config)
+
+  config['cryptoBackend'] = cpb.nativeCrypto.selectCryptoBackend(
+    config['cpf'].get('cryptoBackend', 'auto')
+  )
+
   if 'validFor' not in caData :
     caData['days'] = 10*366 # just over 10 years
   else :
@@ -195,50 +749,52 @@ def normalizeConfig(config) :
       days = days + validFor['days']
     caData['days'] = days
 
-  if 'serialNum' not in caData :
-    caData['serialNum'] = int(time.time()) * 10000
+  loadSerials(config)
 
   config['cpf']['rsync'] = { }
   normalizeSshEntity(config, config['cpf']['rsync'], 'certificateAuthorityDir')
 
-  entityNum = 0
-  normalizeSslEntity(config, caData, entityNum, 'certificateAuthorityDir', caData, None)
-  entityNum += 1
+  normalizeSslEntity(config, caData, 'certificateAuthorityDir', caData, None)
 
-  podDefaults = config['cpf']['podDefaults']
-
-  for aPod in config['cpf']['computePods'] :
-    normalizeSslEntity(config, aPod, entityNum, 'podsDir', caData, podDefaults)
-    entityNum += 1
+  normalizeNatsServers(config)
 
-  natsDefaults = config['cpf']['natsDefaults']
-  natsServer = config['cpf']['natsServer']
-  natsPod = {
-    'host': natsServer['host'],
-    'name': 'natsServer',
-    'podName' : "{}-natsServer".format(config['federationName']),
-    'images' : [ ]
-  }
-  config['cpf']['natsPod'] = natsPod
-  normalizeSslEntity(config, natsPod, entityNum, 'natsDir', caData, natsDefaults)
-  entityNum += 1
+  # (the placed images are added to the pods before they are normalized)
+  with cpb.trace.phase('placeImages') :
+    cpb.placement.placeImages(config)
 
-  majorDomoDefaults = config['cpf']['majorDomoDefaults']
+  # The pods, nats pods and users are only normalized (one at a time) as
+  # they are created or listed (see iterEntities), so that the normalized
+  # configuration stays small however large the federation grows. Their
+  # serial numbers and passwords are allocated here, for the whole
+  # federation, so that they do not depend upon which entities are used.
+  for aPod in config['cpf']['computePods'] :
+    reserveSslEntity(config, aPod, 'podsDir')
+  for aServer in config['cpf']['natsServers'] :
+    reserveSslEntity(config, { 'name' : aServer['name'] }, 'natsDir')
   for aUser in config['cpf']['users'] :
-    aUser['images'] = [ ]
-    #aUser['podName'] = "{}-{}-majorDomoServer".format(
-    #  config['federationName'],
-    #  aUser['name']
-    #)
-    normalizeSslEntity(config, aUser, entityNum, 'usersDir', caData, majorDomoDefaults)
-    entityNum += 1
+    reserveSslEntity(config, aUser, 'usersDir')
 
   if config['verbose'] :
-    logging.info("configuration:\n------\n" + yaml.dump(config) + "------\n")
+    logging.info("reserved {} pods, {} users (next serial: {})".format(
+      len(config['cpf']['computePods']), len(config['cpf']['users']),
+      config['serials']['nextSerial']
+    ))
 
 ############################################################################
 # Creation methods
 
+# Run a (shell) command echoing its output (so that the output can be
+# collected when run in a worker process)
+#
+def echoCommand(cmd) :
+  with cpb.trace.subprocessPhase(cmd) as traceArgs :
+    result = subprocess.run(cmd, shell=True,
+      stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    traceArgs['exitCode'] = result.returncode
+  if result.stdout :
+    click.echo(result.stdout, nl=False)
+  return result.returncode
+
 def createWorkDirFor(msg, eData) :
   if not os.path.isdir(eData['workDir']) :
     logging.info("creating the {} {} work directory".format(msg, eData['name']))
@@ -251,14 +807,15 @@ def createSshKeyFor(msg, eData) :
   else :
     #cmd = "ssh-keygen -N {} -b {} -t rsa -C {} -f {}".format(
     #   eData['password'], eData['keySize'], eData['comment'], eData['keyFile'])
-    cmd = "ssh-keygen -N '' -b {} -t rsa -C {} -f {}".format(
-      eData['keySize'], eData['comment'], eData['keyFile']
+    cmd = "ssh-keygen -N '' {} -C {} -f {}".format(
+      keyTypes[eData['keyType']]['sshKeygen'].format(keySize=eData['keySize']),
+      eData['comment'], eData['keyFile']
     )
     click.echo("\ncreating the {} {} ssh key".format(msg, eData['name']))
     click.echo("-------------------------------")
     click.echo(cmd)
     click.echo("----ssh-key-file-generation----")
-    os.system(cmd)
+    echoCommand(cmd)
     click.echo("----ssh-key-file-generation----")
 
   eData['publicKey'] = "ssh-keygen-failure"
@@ -271,22 +828,25 @@ def createSshKeyFor(msg, eData) :
 def createKeyFor(msg, eData) :
   if os.path.isfile(eData['keyFile']) :
     logging.info("{} {} key file exists -- not recreating".format(msg, eData['name']))
+  elif eData['cryptoBackend'] == 'native' :
+    cpb.nativeCrypto.createKey(msg, eData)
   else :
-    cmd = "openssl genpkey -algorithm RSA -out {} -pkeyopt rsa_keygen_bits:{}".format(
-      eData['keyFile'], eData['keySize']
+    cmd = "openssl genpkey -out {} {}".format(
+      eData['keyFile'],
+      keyTypes[eData['keyType']]['genpkey'].format(keySize=eData['keySize'])
     )
-    click.echo("\ncreating the {} {} rsa key".format(msg, eData['name']))
+    click.echo("\ncreating the {} {} {} key".format(msg, eData['name'], eData['keyType']))
     click.echo("-------------------------------")
     click.echo(cmd)
-    click.echo("----rsa-key-file-generation----")
-    os.system(cmd)
-    click.echo("----rsa-key-file-generation----")
+    click.echo("----key-file-generation----")
+    echoCommand(cmd)
+    click.echo("----key-file-generation----")
 
 # Cerate a new "base" x509 Certificate (in the openSSL configuration)
 # based upon the CA's configured certificate information.
 #
 #    SignatureAlgorithm: x509.SHA512WithRSA, (command line??)
-#    serialNumber (we use unixTimeStamp * 10000 + entityNumber)
+#    serialNumber (allocated from the serials registry, see above)
 #    days on command line (default is 10 366 day years)
 #
 #    organization
@@ -335,15 +895,27 @@ def createKeyFor(msg, eData) :
 #      x509.KeyUsageKeyAgreement |
 #      x509.KeyUsageDataEncipherment
 #
-# It is CRITICAL that we use DIFFERENT serial numbers for each of the:
-#  - Certificate Authority:  unixTimeStamp + 0,
-#  - Clien/Server:           unixTimeStamp + entityNum (pods first)
-#  - User:                   unixTimeStamp + entiryNum (users second)
-# certificates. We do this using the "serialNumModifier" parameter. (This
-# assumes a maximum of 10,000 pods/users)
+# It is CRITICAL that we use DIFFERENT serial numbers for each of the
+# Certificate Authority, Client/Server (pod) and User certificates. We do
+# this by allocating each entity's serial number (once) from the serials
+# registry (see allocateSerial).
 #
 
+def altNameOf(anAltName) :
+  try :
+    ipaddress.ip_address(anAltName)
+    return "IP:{}".format(anAltName)
+  except ValueError :
+    return "DNS:{}".format(anAltName)
+
 def createCertFor(msg, certData, caData) :
+  if certData['cryptoBackend'] == 'native' :
+    if os.path.isfile(certData['certFile']) :
+      logging.info("{} {} certificate file exists -- not recreating".format(msg, certData['name']))
+    else :
+      cpb.nativeCrypto.createCert(msg, certData, caData)
+    return
+
   if os.path.isfile(certData['sslConfigFile']) :
     logging.info("{} {} openssl configuration file exists -- not recreating".format(msg, certData['name']))
   else :
@@ -373,6 +945,11 @@ def createCertFor(msg, certData, caData) :
       "  extendedKeyUsage = serverAuth, clientAuth",
       "  nsCertType       = client, server",
     ]
+    if certData.get('altNames', None) :
+      # (the nats servers verify the host names of each other's certificates)
+      configCert.append("  subjectAltName   = {}".format(
+        ", ".join(altNameOf(anAltName) for anAltName in certData['altNames'])
+      ))
     if caData is None :
       # certificate authority
       configCert = [
@@ -406,7 +983,7 @@ def createCertFor(msg, certData, caData) :
       click.echo("-------------------------------")
       click.echo(cmd)
       click.echo("----csr-file-generation----")
-      os.system(cmd)
+      echoCommand(cmd)
       click.echo("----csr-file-generation----")
 
   if os.path.isfile(certData['certFile']) :
@@ -422,21 +999,22 @@ def createCertFor(msg, certData, caData) :
       # client/server Cert (using CSR created above)
       # see: https://gist.github.com/nordineb/4e8f9122f6962c33e56f02d0d5794b3d
       #
-      cmd = "openssl x509 -req -in {} -out {} -CA {} -CAkey {} -days {} -set_serial {}".format(
+      cmd = "openssl x509 -req -in {} -out {} -CA {} -CAkey {} -days {} -set_serial {} -extfile {} -extensions the_cert".format(
         certData['csrFile'], certData['certFile'],
         caData['certFile'], caData['keyFile'],
-        certData['days'], certData['serialNum']
+        certData['days'], certData['serialNum'],
+        certData['sslConfigFile']
       )
 
     click.echo("\ncreating the {} {} certificate file".format(msg, certData['name']))
     click.echo("-------------------------------")
     click.echo(cmd)
     click.echo("----cert-file-generation----")
-    os.system(cmd)
+    echoCommand(cmd)
     click.echo("----cert-file-generation----")
     click.echo("")
 
-def renderTemplate(aRenderedFile, eData) :
+def renderTemplate(aRenderedFile, eData, config) :
 
   templateName = aRenderedFile['templateName']
   renderedName = aRenderedFile['renderedName']
@@ -446,10 +1024,8 @@ def renderTemplate(aRenderedFile, eData) :
   filePath = eData['podScriptFile']
   os.makedirs(os.path.dirname(filePath), exist_ok=True)
   aRenderedFile['filePath'] = filePath
-  theTemplate = importlib.resources.read_text('cpb.resources', templateName)
   try:
-    template = jinja2.Template(theTemplate)
-    fileContents = template.render(eData)
+    fileContents = cpb.templates.render(config, 'resources/'+templateName, eData)
     with open(filePath, 'w') as outFile :
       outFile.write(fileContents)
     os.chmod(filePath,
@@ -467,35 +1043,54 @@ def addRFile(templateName, renderedName, renderedDir) :
     'renderedDir'  : renderedDir
   }
 
-def createPod(podData, config, extraRFiles) :
-
-  logging.info("creating the pod {} scripts".format(podData['podName']))
-
+def listRenderedFiles(podData, extraRFiles) :
   rFiles = []
   rFiles.append(addRFile('podCreation.sh.j2',      'create-pod.sh',     'scripts'))
   rFiles.append(addRFile('podRemoval.sh.j2',       'remove-pod.sh',     'scripts'))
   rFiles.append(addRFile('imageRemoval.sh.j2',     'remove-images.sh',  'scripts'))
   rFiles.append(addRFile('podStart.sh.j2',         'start-pod.sh',      'scripts'))
   rFiles.append(addRFile('podStop.sh.j2',          'stop-pod.sh',       'scripts'))
+  rFiles.append(addRFile('podKube.yaml.j2',        'kube-pod.yaml',     'scripts'))
   rFiles.append(addRFile('podReadme.md.j2',        'Readme.md',         ''       ))
-  rFiles.append(addRFile('podCommonsReadme.md.j2', 'Readme-commons.md', 'commons'))
+  if 'commonPayload' not in podData :
+    rFiles.append(addRFile('podCommonsReadme.md.j2', 'Readme-commons.md', 'commons'))
   for anRFile in extraRFiles :
     rFiles.append(anRFile)
 
-  # render the known templates
-  for anRFile in rFiles :
-    renderTemplate(anRFile, podData)
-
-  # add the image templates
-  for anImage in podData['images'] :
+  # add the container templates
+  for aContainer in podData['containers'] :
     anRFile = addRFile(
       'enterContainer.sh.j2',
-      'enter-{}.sh'.format(anImage),
+      'enter-{}.sh'.format(aContainer['name']),
       'scripts'
     )
-    podData['anImage'] = anImage
-    renderTemplate(anRFile, podData)
+    anRFile['aContainer'] = aContainer
     rFiles.append(anRFile)
+  return rFiles
+
+# Remove the enter scripts of any containers which no longer exist (for
+# example when the number of replicas of an image changes)
+#
+def removeStaleEnterScripts(podData, rFiles) :
+  scriptsDir = os.path.join(podData['workDir'], 'scripts')
+  if not os.path.isdir(scriptsDir) : return
+  renderedNames = set(anRFile['renderedName'] for anRFile in rFiles)
+  for aFileName in os.listdir(scriptsDir) :
+    if aFileName.startswith('enter-') and aFileName not in renderedNames :
+      os.remove(os.path.join(scriptsDir, aFileName))
+
+def createPod(podData, config, extraRFiles) :
+
+  logging.info("creating the pod {} scripts".format(podData['podName']))
+
+  # render the known templates
+  with cpb.trace.phase('renderTemplates', entity=podData['name']) :
+    rFiles = listRenderedFiles(podData, extraRFiles)
+    removeStaleEnterScripts(podData, rFiles)
+    for anRFile in rFiles :
+      if 'aContainer' in anRFile :
+        podData['aContainer'] = anRFile['aContainer']
+      renderTemplate(anRFile, podData, config)
 
   def copyFile(subDir, origFilePath) :
     fileName = os.path.basename(origFilePath)
@@ -505,14 +1100,38 @@ def createPod(podData, config, extraRFiles) :
     shutil.copyfile(origFilePath, newFilePath)
     os.chmod(newFilePath,
       stat.S_IRUSR | stat.S_IWUSR)
-  copyFile('config', config['cpf']['rsync']['keyFile'])
-  copyFile('config', config['cpf']['rsync']['keyFile']+'.pub')
+
+  if 'natsTls' in podData :
+    # the nats servers verify each other's (cluster) certificates
+    copyFile('config', config['cpf']['certificateAuthority']['certFile'])
+
+  if 'commonPayload' in podData :
+    # the shared files are installed by the federation's common payload
+    rsyncKeyFileName = os.path.basename(config['cpf']['rsync']['keyFile'])
+    for aSharedFile in [
+      os.path.join('config',  rsyncKeyFileName),
+      os.path.join('config',  rsyncKeyFileName+'.pub'),
+      os.path.join('commons', 'Readme-commons.md')
+    ] :
+      aSharedFile = os.path.join(podData['workDir'], aSharedFile)
+      if os.path.exists(aSharedFile) :
+        os.remove(aSharedFile)
+  else :
+    copyFile('config', config['cpf']['rsync']['keyFile'])
+    copyFile('config', config['cpf']['rsync']['keyFile']+'.pub')
 
   logging.info("creating the pod {} install acrchive".format(podData['podName']))
+  with cpb.trace.phase('makeself', entity=podData['name']) :
+    makeInstallArchive(
+      podData['workDir'],
+      podData['makeSelfFile'],
+      f"Install the {podData['name']} pod configuration and scripts",
+      podData['password'],
+      config['packaging']
+    )
 
-  podData['podTmpFile'] = 'postInstall'
-  sanitizeFilePath(podData, 'podTmpFile', podData['workDir'])
-  postInstallPath = podData['podTmpFile']
+def makeInstallArchive(contentDir, archiveFile, label, password, packaging) :
+  postInstallPath = os.path.join(contentDir, 'postInstall')
   with open(postInstallPath, 'w') as piFile :
     piFile.write("""
 # This is the postInstall file for the makeself installation system.
@@ -552,78 +1171,508 @@ for aChild in archiveDir.iterdir() :
 #
 #    Return:
 #    Path to self-extracting installer executable.
-  makeself.make_package(
-    podData['workDir'],
-    podData['makeSelfFile'],
-    "postInstall",
-    [],
-    label=f"Install the {podData['name']} pod configuration and scripts",
-    password=podData['password']
+#
+  # make_package changes the current directory (and does not change it
+  # back if it fails), which would confuse any later entity created by
+  # the same (reused) worker process
+  origDir = os.getcwd()
+  try :
+    makeself.make_package(
+      contentDir,
+      archiveFile,
+      "postInstall",
+      [],
+      compress=packaging['compress'],
+      label=label,
+      password=password
+    )
+  finally :
+    os.chdir(origDir)
+
+############################################################################
+# Packaging
+#
+# By default (packaging mode `perPod`) each pod's install archive contains
+# all of the files needed by the pod.
+#
+# In the `shared` packaging mode, the files which are the same for every
+# pod (the commons Readme and the federation's rsync key pair) are placed
+# in one common payload, which is built once per federation. The name of
+# the common payload contains the hash of its contents, so it is only
+# rebuilt when its contents change. Each pod's install archive then only
+# contains the pod's own files.
+
+defaultPackaging = {
+  'mode'     : 'perPod',
+  'compress' : 'gz',
+}
+
+# pymakeself can only compress its archives using gz, bz2, or xz (at the
+# default level of python's tarfile module), so any other compression
+# (such as zstd) or compression level is an error
+#
+packagingCompressions = [ 'gz', 'bz2', 'xz' ]
+
+def normalizePackaging(config) :
+  packaging = dict(defaultPackaging)
+  packaging.update(config['cpf'].get('packaging', {}))
+  if packaging['mode'] not in [ 'perPod', 'shared' ] :
+    logging.error("Unknown packaging mode [{}] (must be perPod or shared)".format(packaging['mode']))
+    sys.exit(-1)
+  if packaging['compress'] not in packagingCompressions :
+    logging.error("The {} compression is not supported by pymakeself (must be one of: {})".format(
+      packaging['compress'], ", ".join(packagingCompressions)
+    ))
+    sys.exit(-1)
+  if 'level' in packaging :
+    logging.error("pymakeself does not support compression levels (remove the packaging level: {})".format(
+      packaging['level']
+    ))
+    sys.exit(-1)
+  config['packaging'] = packaging
+
+def createCommonPayload(config) :
+  rsyncData = config['cpf']['rsync']
+  commonFiles = {
+    os.path.join('config', os.path.basename(rsyncData['keyFile'])) :
+      rsyncData['keyFile'],
+    os.path.join('config', os.path.basename(rsyncData['keyFile'])+'.pub') :
+      rsyncData['keyFile']+'.pub',
+  }
+  commonContents = {
+    os.path.join('commons', 'Readme-commons.md') : cpb.templates.render(
+      config, 'resources/podCommonsReadme.md.j2', {}
+    ).encode()
+  }
+  for anArchivePath, aFilePath in commonFiles.items() :
+    with open(aFilePath, 'rb') as aFile :
+      commonContents[anArchivePath] = aFile.read()
+
+  aHash = hashlib.sha256()
+  aHash.update(config['packaging']['compress'].encode())
+  for anArchivePath in sorted(commonContents.keys()) :
+    aHash.update(anArchivePath.encode())
+    aHash.update(hashlib.sha256(commonContents[anArchivePath]).digest())
+  payloadName = "install-{}-common-{}.run".format(
+    config['federationName'], aHash.hexdigest()[:12]
+  )
+  payloadFile = os.path.join(os.path.dirname(os.path.abspath(config['podsDir'])), payloadName)
+
+  if os.path.isfile(payloadFile) :
+    logging.info("the common payload {} exists -- not recreating".format(payloadName))
+    return payloadName
+
+  click.echo("\ncreating the {} common payload".format(payloadName))
+  payloadDir = os.path.join(config['certificateAuthorityDir'], 'commonPayload')
+  if os.path.isdir(payloadDir) :
+    shutil.rmtree(payloadDir)
+  for anArchivePath, someContents in commonContents.items() :
+    aPath = os.path.join(payloadDir, anArchivePath)
+    os.makedirs(os.path.dirname(aPath), exist_ok=True)
+    with open(aPath, 'wb') as aFile :
+      aFile.write(someContents)
+    os.chmod(aPath, stat.S_IRUSR | stat.S_IWUSR)
+  makeInstallArchive(
+    payloadDir,
+    payloadFile,
+    f"Install the {config['federationName']} common files",
+    rsyncData['password'],
+    config['packaging']
   )
+  return payloadName
+
+############################################################################
+# Input manifest
+#
+# To avoid re-rendering and re-archiving pods whose inputs have not
+# changed, we keep a manifest of the SHA256 hash of each pod's inputs:
+#   - the normalized pod data (including its serial number, which is
+#     stable, so that a reallocated serial number regenerates the pod),
+#   - the sources of the templates rendered for the pod,
+#   - the pod's key and certificate files,
+#   - the federation's rsync key files,
+#   - the certificate authority's certificate (for the pods into which it
+#     is copied, for example clustered nats pods).
+
+# These (normalized) pod data keys are only used while rendering and so
+# are not inputs
+#
+volatilePodKeys = [ 'podScriptFile', 'podTmpFile', 'aContainer' ]
+
+def loadCreateManifest(config) :
+  config['createManifest'] = {}
+  try :
+    with open(config['createManifestYaml'], 'r') as manifestFile :
+      createManifest = yamlLoad(manifestFile)
+    if createManifest is not None :
+      config['createManifest'] = createManifest
+  except IOError :
+    logging.info("could not load the create manifest file: [{}]".format(config['createManifestYaml']))
+
+def savePasswords(config) :
+  passwordsFile = open(config['passwordsYaml'], 'w')
+  passwordsFile.write(yaml.dump(config['passwords']))
+  passwordsFile.close()
+  os.chmod(config['passwordsYaml'], stat.S_IRUSR | stat.S_IWUSR)
+
+def saveCreateManifest(config) :
+  with open(config['createManifestYaml'], 'w') as manifestFile :
+    manifestFile.write(yaml.dump(config['createManifest']))
+
+def hashFile(aHash, filePath) :
+  aHash.update(filePath.encode())
+  try :
+    with open(filePath, 'rb') as aFile :
+      aHash.update(hashlib.sha256(aFile.read()).digest())
+  except IOError :
+    aHash.update(b'missing')
+
+def computePodInputsHash(podData, config, extraRFiles) :
+  aHash = hashlib.sha256()
+
+  podInputs = {
+    aKey : aValue for aKey, aValue in podData.items()
+      if aKey not in volatilePodKeys
+  }
+  aHash.update(json.dumps(podInputs, sort_keys=True, default=str).encode())
+
+  templateNames = sorted(set(
+    anRFile['templateName'] for anRFile in listRenderedFiles(podData, extraRFiles)
+  ))
+  for aTemplateName in templateNames :
+    aHash.update(aTemplateName.encode())
+    aHash.update(importlib.resources.read_text('cpb.resources', aTemplateName).encode())
+
+  hashFile(aHash, podData['keyFile'])
+  hashFile(aHash, podData['certFile'])
+  hashFile(aHash, config['cpf']['rsync']['keyFile'])
+  hashFile(aHash, config['cpf']['rsync']['keyFile']+'.pub')
+  if 'natsTls' in podData :
+    hashFile(aHash, config['cpf']['certificateAuthority']['certFile'])
+  return aHash.hexdigest()
+
+def manifestKey(msg, eData) :
+  return "{}/{}".format(msg, eData['name'])
 
 ############################################################################
 # Do the work...
 
-@click.command("create")
-@click.pass_context
-def create(ctx):
-  """
-  (re)Creates any missing compute pod descriptions.
+# The per-entity work (key, certificate, scripts and install archive) is
+# done in worker processes. Each worker is only sent the entity's own
+# (normalized) data, together with the small federation wide
+# configuration needed to create any entity (and the hash of the
+# entity's inputs when it was last created), so that the memory used by
+# the workers does not grow with the size of the federation.
+#
+def sharedCreateConfig(config) :
+  return {
+    'buildBaseDir'    : config['buildBaseDir'],
+    'strictTemplates' : config.get('strictTemplates', False),
+    'packaging'       : config['packaging'],
+    'forceCreate'     : config['forceCreate'],
+    'cpf'             : {
+      'certificateAuthority' : config['cpf']['certificateAuthority'],
+      'rsync'                : config['cpf']['rsync'],
+    }
+  }
 
-  """
-  config = ctx.obj
-  normalizeConfig(config)
+# Create an entity's key and certificate, and then (re)render and
+# (re)archive its scripts if any of its inputs have changed.
+#
+# Returns the hash of the entity's inputs and whether or not the entity
+# has been regenerated.
+#
+def createEntity(msg, eData, extraRFiles, sharedConfig, oldInputsHash) :
+  with cpb.trace.phase('createEntity', entity=eData['name'], kind=msg) as traceArgs :
+    inputsHash, regenerated = createEntityFiles(
+      msg, eData, extraRFiles, sharedConfig, oldInputsHash
+    )
+    traceArgs['regenerated'] = regenerated
+  return inputsHash, regenerated
+
+def createEntityFiles(msg, eData, extraRFiles, sharedConfig, oldInputsHash) :
+  caData = sharedConfig['cpf']['certificateAuthority']
+  createWorkDirFor(msg, eData)
+  createKeyFor(msg, eData)
+  createCertFor(msg, eData, caData)
+
+  inputsHash = computePodInputsHash(eData, sharedConfig, extraRFiles)
+  if not sharedConfig['forceCreate'] \
+    and oldInputsHash == inputsHash \
+    and os.path.isfile(eData['makeSelfFile']) :
+    logging.info("the {} {} is unchanged -- not regenerating".format(msg, eData['name']))
+    return inputsHash, False
+
+  createPod(eData, sharedConfig, extraRFiles)
+  return inputsHash, True
+
+# Run `createEntity` collecting all of its output (so that the output of
+# concurrent workers is not interleaved) as well as any trace events
+# (which are returned to the parent process).
+#
+def createEntityQuietly(msg, eData, extraRFiles, sharedConfig, oldInputsHash) :
+  cpb.trace.takeEvents()
+  ok, output, result = createEntityCollectingOutput(
+    msg, eData, extraRFiles, sharedConfig, oldInputsHash
+  )
+  return ok, output, result, cpb.trace.takeEvents()
 
-  click.echo("\n(re)Creating the {} federation".format(config['cpf']['federationName']))
+# Run `createEntity` (collecting its output in the same way) in this
+# process, where its trace events are recorded directly
+#
+def createEntityInProcess(msg, eData, extraRFiles, sharedConfig, oldInputsHash) :
+  ok, output, result = createEntityCollectingOutput(
+    msg, eData, extraRFiles, sharedConfig, oldInputsHash
+  )
+  return ok, output, result, []
 
-  click.echo("\nWorking on certificate authority")
+# (the helpers report problems and then exit, which, like any other
+# error, only fails the one entity)
+#
+def createEntityCollectingOutput(msg, eData, extraRFiles, sharedConfig, oldInputsHash) :
+  output = io.StringIO()
+  logHandlers = logging.getLogger().handlers
+  oldStreams = [ aHandler.setStream(output) for aHandler in logHandlers ]
+  try :
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output) :
+      result = createEntity(msg, eData, extraRFiles, sharedConfig, oldInputsHash)
+  except (Exception, SystemExit) as err :
+    return False, output.getvalue() + "\nERROR: {}\n".format(repr(err)), None
+  finally :
+    for aHandler, aStream in zip(logHandlers, oldStreams) :
+      aHandler.setStream(aStream)
+  return True, output.getvalue(), result
+
+# Generate (msg, eData, extraRFiles) for each of the pods, the nats pods
+# and the users. Each entity is normalized (from a copy of its
+# description) only as it is generated, so that the entities can be
+# streamed to the workers without the whole federation's normalized data
+# ever being held in memory.
+#
+def iterPods(config) :
   caData = config['cpf']['certificateAuthority']
-  createWorkDirFor("certificate authority", caData)
-  createKeyFor("certificate authority", caData)
-  createCertFor("certificate authority", caData, None)
-
-  click.echo("\n(re)Creating the {} rsync ssh key".format(config['cpf']['federationName']))
-  createSshKeyFor('rsync', config['cpf']['rsync'])
 
+  podDefaults = config['cpf']['podDefaults']
   for aPod in config['cpf']['computePods'] :
-    click.echo("\nWorking on {} pod".format(aPod['name']))
-    createWorkDirFor("pod", aPod)
-    createKeyFor("pod", aPod)
-    createCertFor("pod", aPod, caData)
-    createPod(aPod, config, [ addRFile(
+    podData = dict(aPod)
+    normalizeSslEntity(config, podData, 'podsDir', caData, podDefaults)
+    yield ('pod', podData, [ addRFile(
       'cpchefConfig.yaml.j2',
       'cpchefConfig.yaml',
       'config'
     )])
 
-  aPod = config['cpf'] ['natsPod']
-  click.echo("\nWorking on {} pod".format(aPod['podName']))
-  createWorkDirFor("pod", aPod)
-  createKeyFor("pod", aPod)
-  createCertFor("pod", aPod, caData)
-  createPod(aPod, config, [ addRFile(
-    'natsConfig.conf.j2',
-    'natsConfig.conf',
-    'config'
-  )])
+  natsDefaults = config['cpf']['natsDefaults']
+  for aServer in config['cpf']['natsServers'] :
+    natsPod = natsPodFor(config, aServer)
+    normalizeSslEntity(config, natsPod, 'natsDir', caData, natsDefaults)
+    normalizeNatsPod(config, natsPod, aServer, caData)
+    yield ('pod', natsPod, [ addRFile(
+      'natsConfig.conf.j2',
+      'natsConfig.conf',
+      'config'
+    )])
+
+def iterUsers(config) :
+  caData = config['cpf']['certificateAuthority']
 
+  majorDomoDefaults = config['cpf']['majorDomoDefaults']
   for aUser in config['cpf']['users'] :
-    click.echo("\nWorking on {} user".format(aUser['name']))
-    createWorkDirFor("user", aUser)
-    createKeyFor("user", aUser)
-    createCertFor("user", aUser, caData)
-    createPod(aUser, config,  [ addRFile(
+    userData = dict(aUser)
+    userData['images'] = [ ]
+    #userData['podName'] = "{}-{}-majorDomoServer".format(
+    #  config['federationName'],
+    #  userData['name']
+    #)
+    normalizeSslEntity(config, userData, 'usersDir', caData, majorDomoDefaults)
+    yield ('user', userData, [ addRFile(
       'cpmdConfig.yaml.j2',
       'cpmdConfig.yaml',
       'config'
     )])
 
+def iterEntities(config) :
+  yield from iterPods(config)
+  yield from iterUsers(config)
+
+# The names (and host/pod names) which can be used to select an entity
+#
+def entityNames(msg, eData) :
+  return [ eData['name'], eData.get('podName', None), eData.get('host', None) ]
+
+# Select the pods (and nats pod) and users (using the `--pod` and `--user`
+# selectors). If no selectors are given, every entity is selected. The
+# `matchedSelectors` are recorded (so that unused selectors can be
+# reported).
+#
+def selectEntities(entities, podSelectors, userSelectors, matchedSelectors) :
+  # (the names of users have any '@' replaced by '-')
+  userSelectors = [ aSelector.replace('@', '-') for aSelector in userSelectors ]
+  for msg, eData, extraRFiles in entities :
+    if not podSelectors and not userSelectors :
+      yield msg, eData, extraRFiles
+      continue
+    selectors = podSelectors if msg == 'pod' else userSelectors
+    someNames = entityNames(msg, eData)
+    matched = [ aSelector for aSelector in selectors
+      if matchesSelectors(someNames, [ aSelector ]) ]
+    if matched :
+      matchedSelectors.update(matched)
+      yield msg, eData, extraRFiles
+
+# An entity is unchanged if its key, certificate and install archive
+# exist and its inputs have not changed since it was last created.
+#
+def entityIsUnchanged(msg, eData, extraRFiles, config) :
+  for aKey in [ 'keyFile', 'certFile', 'makeSelfFile' ] :
+    if not os.path.isfile(eData[aKey]) :
+      return False
+  return config['createManifest'].get(manifestKey(msg, eData), None) \
+    == computePodInputsHash(eData, config, extraRFiles)
+
+def createFederation(ctx, jobs, force, podSelectors=(), userSelectors=(), onlyChanged=False) :
+  config = cpb.configCache.normalizeWithCache(cpb.config.getConfig(ctx), 'create', normalizeConfig)
+  config['forceCreate'] = force
+  loadCreateManifest(config)
+  # (save any newly allocated serial numbers before they are used)
+  saveSerials(config)
+
+  click.echo("\n(re)Creating the {} federation".format(config['cpf']['federationName']))
+
+  click.echo("\nWorking on certificate authority")
+  caData = config['cpf']['certificateAuthority']
+  with cpb.trace.phase('createCA', entity=caData['name']) :
+    createWorkDirFor("certificate authority", caData)
+    createKeyFor("certificate authority", caData)
+    createCertFor("certificate authority", caData, None)
+
+  click.echo("\n(re)Creating the {} rsync ssh key".format(config['cpf']['federationName']))
+  with cpb.trace.phase('createRsyncKey') :
+    createSshKeyFor('rsync', config['cpf']['rsync'])
+
+  # (serial numbers and the shared artifacts are always computed for the
+  # whole federation, so that they do not depend upon the selection)
+  commonPayload = None
+  if config['packaging']['mode'] == 'shared' :
+    with cpb.trace.phase('createCommonPayload') :
+      commonPayload = createCommonPayload(config)
+
+  sharedConfig     = sharedCreateConfig(config)
+  failed           = []
+  regenerated      = []
+  unchanged        = [ 0 ]
+  matchedSelectors = set()
+
+  # The entities are streamed (generated, selected, checked and then
+  # created) so that very large federations are not all held in flight
+  #
+  def entitiesToCreate() :
+    for msg, eData, extraRFiles in selectEntities(
+      iterEntities(config), podSelectors, userSelectors, matchedSelectors
+    ) :
+      if commonPayload is not None :
+        eData['commonPayload'] = commonPayload
+      if onlyChanged and not force \
+        and entityIsUnchanged(msg, eData, extraRFiles, config) :
+        unchanged[0] += 1
+        continue
+      yield msg, eData, extraRFiles, sharedConfig, \
+        config['createManifest'].get(manifestKey(msg, eData), None)
+
+  def recordResult(msg, eData, result) :
+    inputsHash, wasRegenerated = result
+    config['createManifest'][manifestKey(msg, eData)] = inputsHash
+    if wasRegenerated :
+      regenerated.append(eData['name'])
+    else :
+      unchanged[0] += 1
+
+  # (the results are reported in the same way however many jobs are used)
+  def reportResult(aTask, aResult) :
+    msg, eData = aTask[0], aTask[1]
+    click.echo("\nWorking on {} {}".format(eData['name'], msg))
+    succeeded, output, result, traceEvents = aResult
+    cpb.trace.addEvents(traceEvents)
+    click.echo(output, nl=False)
+    if succeeded :
+      recordResult(msg, eData, result)
+    else :
+      failed.append(eData['name'])
+
+  jobs = max(1, jobs if jobs else 1)
+  try :
+    if jobs == 1 :
+      for aTask in entitiesToCreate() :
+        reportResult(aTask, createEntityInProcess(*aTask))
+    else :
+      with ProcessPoolExecutor(max_workers=jobs,
+        initializer=cpb.trace.enableTracing, initargs=(cpb.trace.tracingEnabled,)) as executor :
+        # report the output of each entity in order
+        for aTask, aResult in cpb.scheduler.runInOrder(
+          executor, createEntityQuietly, entitiesToCreate(), 4*jobs
+        ) :
+          reportResult(aTask, aResult)
+  finally :
+    # (keep the manifest and passwords of the entities which have been
+    # created, even if the federation's description has a problem)
+    saveCreateManifest(config)
+    savePasswords(config)
+
+  for aSelector in list(podSelectors) + list(userSelectors) :
+    if aSelector.replace('@', '-') not in matchedSelectors \
+      and aSelector not in matchedSelectors :
+      logging.warning("No pods/users match the selector [{}]".format(aSelector))
+
+  click.echo("")
+  if regenerated :
+    if len(regenerated) <= 20 :
+      click.echo("Regenerated: {}".format(", ".join(regenerated)))
+    else :
+      click.echo("Regenerated: {} pods/users".format(len(regenerated)))
+  if unchanged[0] :
+    click.echo("Unchanged: {} pods/users".format(unchanged[0]))
   click.echo("")
 
-  passwordsFile = open(config['passwordsYaml'], 'w')
-  passwordsFile.write(yaml.dump(config['passwords']))
-  passwordsFile.close()
-  os.chmod(config['passwordsYaml'], stat.S_IRUSR | stat.S_IWUSR)
+  if failed :
+    logging.error("Could not create: {}".format(", ".join(failed)))
+    sys.exit(-1)
+
+@click.command("create")
+@click.option("-j", "--jobs", default=os.cpu_count(), show_default=True, type=int,
+  help="The number of pods/users to create at the same time.")
+@click.option("-f", "--force", default=False, is_flag=True,
+  help="Regenerate all pods/users even if their inputs have not changed.")
+@click.option("--trace", "tracePath", default=None,
+  help="Write a (Chrome trace-event) trace of the creation to this file.")
+@click.option("--timings", default=False, is_flag=True,
+  help="Print a summary of the time taken by each phase of the creation.")
+@click.option("-p", "--pod", "podSelectors", multiple=True,
+  help="Only create the pods whose name matches this glob (may be repeated).")
+@click.option("-u", "--user", "userSelectors", multiple=True,
+  help="Only create the users whose name matches this glob (may be repeated).")
+@click.option("-c", "--only-changed", "onlyChanged", default=False, is_flag=True,
+  help="Only work on the pods/users whose inputs have changed.")
+@click.pass_context
+def create(ctx, jobs, force, tracePath, timings, podSelectors, userSelectors, onlyChanged):
+  """
+  (re)Creates any missing compute pod descriptions.
+
+  The keys, certificates, scripts and install archives of the pods and
+  users are created in (at most `--jobs`) parallel worker processes, once
+  the certificate authority has been created.
+
+  The scripts and install archives are only regenerated for pods and
+  users whose inputs have changed (unless `--force` is used).
+
+  Use --pod and/or --user to only work on some of the pods and users, and
+  --only-changed to skip (without starting a worker) any pods and users
+  whose inputs have not changed. Serial numbers and shared files are
+  still computed for the whole federation.
+
+  Use --trace and/or --timings to find where the creation spends its time.
+  """
+  with cpb.trace.tracing(tracePath, timings) :
+    createFederation(ctx, jobs, force, podSelectors, userSelectors, onlyChanged)
 
 @click.command("pods")
 @click.pass_context
@@ -632,21 +1681,21 @@ def pods(ctx) :
   lists the pods that will be created by the create command.
   """
 
-  config = ctx.obj
-  normalizeConfig(config)
+  config = cpb.configCache.normalizeWithCache(cpb.config.getConfig(ctx), 'create', normalizeConfig)
 
   print("{} federation pods:".format(config['cpf']['federationName']))
-  config['cpf']['computePods'].append(config['cpf']['natsPod'])
-  for aPod in config['cpf']['computePods'] :
+  for msg, aPod, extraRFiles in iterPods(config) :
     print("  - {}:".format(aPod['podName']))
-    for anImage in aPod['images'] :
+    for aContainer in aPod['containers'] :
       print("    - {}\t({})".format(
-        anImage,
-        aPod['imageLocal'][anImage]
+        aContainer['name'],
+        aPod['imageLocal'][aContainer['image']]
       ))
     #print(yaml.dump(aPod))
     #print("-----------------------------------------------------------")
 
+  cpb.placement.printPlacement(config)
+
 @click.command("users")
 @click.pass_context
 def users(ctx) :
@@ -654,15 +1703,14 @@ def users(ctx) :
   lists the users that will be created by the create command.
   """
 
-  config = ctx.obj
-  normalizeConfig(config)
+  config = cpb.configCache.normalizeWithCache(cpb.config.getConfig(ctx), 'create', normalizeConfig)
 
   print("{} federation users:".format(config['cpf']['federationName']))
-  for aUser in config['cpf']['users'] :
+  for msg, aUser, extraRFiles in iterUsers(config) :
     print("  - {}".format(aUser['name']))
-    for anImage in aUser['images'] :
+    for aContainer in aUser['containers'] :
       print("    - {}\t({})".format(
-        anImage,
-        aUser['imageLocal'][anImage]
+        aContainer['name'],
+        aUser['imageLocal'][aContainer['image']]
       ))
     #print(yaml.dump(aUser))
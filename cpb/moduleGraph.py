@@ -0,0 +1,129 @@
+# This python module provides an index of the graph of cekit modules
+# (each module can install other modules using its `modules.install`
+# list).
+#
+# Modules are only loaded (and their module.yaml parsed) when they are
+# reachable from an image which is used. Each module is looked up in the
+# configured repositories, with modules in later repositories overriding
+# modules in earlier repositories.
+#
+# The transitive closure of each module (the module together with all of
+# the modules it, directly or indirectly, installs) is computed once.
+# Any cycle in the module graph is reported as an error.
+
+import logging
+import os
+import sys
+
+from cpb.utils import *
+
+def initModuleGraph(config) :
+  config['modules']        = {}
+  config['moduleDirs']     = {}
+  config['moduleClosures'] = {}
+
+def findModuleDir(config, aModule) :
+  for aRepo in reversed(config['repositories']) :
+    aModuleDir = os.path.join(aRepo, aModule)
+    if os.path.isdir(aModuleDir) :
+      return aModuleDir
+  return None
+
+# Load (if not already loaded) the module.yaml of the module.
+# Returns None if the module can not be found.
+#
+def loadModule(config, aModule) :
+  modules = config['modules']
+  if aModule in modules :
+    return modules[aModule]
+
+  aModuleDir = findModuleDir(config, aModule)
+  if aModuleDir is None :
+    return None
+
+  modules[aModule] = {}
+  config['moduleDirs'][aModule] = aModuleDir
+  cekitModulePath = os.path.join(aModuleDir, 'module.yaml')
+  if os.path.isfile(cekitModulePath) :
+    try:
+      with open(cekitModulePath, 'r') as moduleFile :
+        logging.info("Loading {}::module.yaml\n      from {}".format(aModule, os.path.dirname(aModuleDir)))
+        moduleYaml = yamlLoad(moduleFile)
+      if moduleYaml is not None :
+        modules[aModule] = moduleYaml
+    except Exception as e :
+      logging.info("Could not load the {} YAML file.".format(cekitModulePath))
+      print("  > " + "\n  >".join(str(e).split("\n")))
+  return modules[aModule]
+
+def subModulesOf(config, aModule) :
+  aModuleYaml = loadModule(config, aModule)
+  if not aModuleYaml or not aModuleYaml.get('modules', None) :
+    return []
+  return [
+    aSubModule['name']
+      for aSubModule in aModuleYaml['modules'].get('install', None) or []
+  ]
+
+# Returns the (ordered) list of the module together with all of the
+# modules it (transitively) installs.
+#
+def moduleClosure(config, aModule, modulePath=None) :
+  closures = config['moduleClosures']
+  if aModule in closures :
+    return closures[aModule]
+
+  if modulePath is None :
+    modulePath = []
+  if aModule in modulePath :
+    cycle = modulePath[modulePath.index(aModule):] + [ aModule ]
+    logging.error("Cekit module cycle found: {}".format(" -> ".join(cycle)))
+    sys.exit(-1)
+
+  closure = [ aModule ]
+  for aSubModule in subModulesOf(config, aModule) :
+    for aClosureModule in moduleClosure(config, aSubModule, modulePath + [ aModule ]) :
+      if aClosureModule not in closure :
+        closure.append(aClosureModule)
+  closures[aModule] = closure
+  return closure
+
+def modulesClosure(config, someModules) :
+  closure = []
+  for aModule in someModules :
+    for aClosureModule in moduleClosure(config, aModule) :
+      if aClosureModule not in closure :
+        closure.append(aClosureModule)
+  return closure
+
+# Returns all of the modules used to build an image (including the
+# modules used by any build stage).
+#
+def imageModules(config, anImageDesc) :
+  return modulesClosure(
+    config, anImageDesc['modules'] + anImageDesc.get('buildModules', [])
+  )
+
+# Returns the images which install a module, either themselves or
+# through any of their parents (once shared base images have been
+# factored out, an image's `modules` no longer lists the modules it
+# inherits from its parents).
+#
+def imagesAffectedBy(config, imageDescs, imageKeys, aModule) :
+  imageParents = config.get('imageParents', {})
+  affected = {}
+  def isAffected(anImageKey, imagePath=[]) :
+    if anImageKey in affected :
+      return affected[anImageKey]
+    if anImageKey in imagePath :
+      return False
+    result = anImageKey in imageDescs \
+      and aModule in imageModules(config, imageDescs[anImageKey])
+    if not result :
+      for aParent in imageParents.get(anImageKey, []) :
+        if isAffected(aParent, imagePath + [ anImageKey ]) :
+          result = True
+          break
+    affected[anImageKey] = result
+    return result
+  return [ anImageKey for anImageKey in imageKeys if isAffected(anImageKey) ]
@@ -0,0 +1,177 @@
+# This python module provides the "native" (in-process) crypto backend
+# used by the create subcommand to create the keys and certificates of
+# the federation's certificate authority, pods and users.
+#
+# It uses the (optional) python cryptography package (see:
+# https://cryptography.io ) to generate keys, build certificate signing
+# requests and sign certificates in memory. Only the final key and
+# certificate PEM files are written to disk.
+#
+# It uses the same distinguished name and extension rules as the openssl
+# configuration created by `cpb.create.createCertFor`.
+
+import click
+import datetime
+import ipaddress
+import logging
+import os
+
+try :
+  from cryptography import x509
+  from cryptography.hazmat.primitives import hashes, serialization
+  from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+  from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+  nativeCryptoAvailable = True
+except ImportError :
+  nativeCryptoAvailable = False
+
+# The Netscape certificate type (nsCertType) extension as DER encoded
+# BIT STRINGs (bits: 0 client, 1 server, 5 sslCA, 7 objCA)
+#
+nsCertTypeOid          = '2.16.840.1.113730.1.1'
+nsCertTypeClientServer = bytes([ 0x03, 0x02, 0x06, 0xC0 ])
+nsCertTypeSslCaObjCa   = bytes([ 0x03, 0x02, 0x00, 0x05 ])
+
+# Choose the crypto backend to use. The 'auto' backend uses the native
+# backend if the cryptography package is installed, otherwise it falls
+# back to using the openssl command line tool.
+#
+def selectCryptoBackend(backendName) :
+  if backendName not in [ 'auto', 'native', 'openssl' ] :
+    logging.warning("Unknown cryptoBackend [{}] using 'auto'".format(backendName))
+    backendName = 'auto'
+  if backendName == 'openssl' :
+    return 'openssl'
+  if nativeCryptoAvailable :
+    return 'native'
+  if backendName == 'native' :
+    logging.warning("The python cryptography package is not installed")
+    logging.warning("  using the openssl command line tool instead")
+  return 'openssl'
+
+def writePemFile(filePath, pemBytes, fileMode=0o600) :
+  fileDesc = os.open(filePath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, fileMode)
+  with os.fdopen(fileDesc, 'wb') as pemFile :
+    pemFile.write(pemBytes)
+
+def loadPrivateKey(keyFile) :
+  with open(keyFile, 'rb') as pemFile :
+    return serialization.load_pem_private_key(pemFile.read(), password=None)
+
+def loadCertificate(certFile) :
+  with open(certFile, 'rb') as pemFile :
+    return x509.load_pem_x509_certificate(pemFile.read())
+
+def generatePrivateKey(keyType, keySize) :
+  if keyType == 'ecdsa-p256' :
+    return ec.generate_private_key(ec.SECP256R1())
+  if keyType == 'ecdsa-p384' :
+    return ec.generate_private_key(ec.SECP384R1())
+  if keyType == 'ed25519' :
+    return ed25519.Ed25519PrivateKey.generate()
+  return rsa.generate_private_key(public_exponent=65537, key_size=int(keySize))
+
+# Ed25519 keys sign without a (separate) digest algorithm
+#
+def signingHash(signingKey) :
+  if isinstance(signingKey, ed25519.Ed25519PrivateKey) :
+    return None
+  return hashes.SHA256()
+
+def createKey(msg, eData) :
+  click.echo("\ncreating the {} {} {} key (native)".format(msg, eData['name'], eData['keyType']))
+  privateKey = generatePrivateKey(eData['keyType'], eData['keySize'])
+  writePemFile(eData['keyFile'], privateKey.private_bytes(
+    encoding=serialization.Encoding.PEM,
+    format=serialization.PrivateFormat.PKCS8,
+    encryption_algorithm=serialization.NoEncryption()
+  ))
+
+def distinguishedName(certData) :
+  return x509.Name([
+    x509.NameAttribute(NameOID.COUNTRY_NAME,             str(certData['country'])),
+    x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME,   str(certData['province'])),
+    x509.NameAttribute(NameOID.LOCALITY_NAME,            str(certData['locality'])),
+    x509.NameAttribute(NameOID.ORGANIZATION_NAME,        str(certData['organization'])),
+    x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, str(certData['federationName'])),
+    x509.NameAttribute(NameOID.COMMON_NAME,              str(certData['name'])),
+  ])
+
+def certExtensions(isCA, altNames=None) :
+  if isCA :
+    # certificate authority
+    return [
+      x509.BasicConstraints(ca=True, path_length=None),
+      x509.KeyUsage(
+        digital_signature=True, content_commitment=True,
+        key_encipherment=False, data_encipherment=False,
+        key_agreement=False, key_cert_sign=True, crl_sign=True,
+        encipher_only=False, decipher_only=False
+      ),
+      x509.UnrecognizedExtension(
+        x509.ObjectIdentifier(nsCertTypeOid), nsCertTypeSslCaObjCa
+      ),
+    ]
+  # client/server (both pods and users)
+  extensions = [
+    x509.BasicConstraints(ca=False, path_length=None),
+    x509.KeyUsage(
+      digital_signature=True, content_commitment=True,
+      key_encipherment=True, data_encipherment=False,
+      key_agreement=True, key_cert_sign=False, crl_sign=False,
+      encipher_only=False, decipher_only=False
+    ),
+    x509.ExtendedKeyUsage([
+      ExtendedKeyUsageOID.SERVER_AUTH, ExtendedKeyUsageOID.CLIENT_AUTH
+    ]),
+    x509.UnrecognizedExtension(
+      x509.ObjectIdentifier(nsCertTypeOid), nsCertTypeClientServer
+    ),
+  ]
+  if altNames :
+    extensions.append(x509.SubjectAlternativeName([
+      altNameOf(anAltName) for anAltName in altNames
+    ]))
+  return extensions
+
+def altNameOf(anAltName) :
+  try :
+    return x509.IPAddress(ipaddress.ip_address(anAltName))
+  except ValueError :
+    return x509.DNSName(anAltName)
+
+def createCert(msg, certData, caData) :
+  click.echo("\ncreating the {} {} certificate file (native)".format(msg, certData['name']))
+  privateKey = loadPrivateKey(certData['keyFile'])
+
+  # client/server CSR (built in memory)
+  csr = x509.CertificateSigningRequestBuilder().subject_name(
+    distinguishedName(certData)
+  ).sign(privateKey, signingHash(privateKey))
+
+  signingKey = privateKey
+  issuerName = csr.subject
+  if caData is not None :
+    signingKey = loadPrivateKey(caData['keyFile'])
+    issuerName = loadCertificate(caData['certFile']).subject
+
+  notBefore = datetime.datetime.now(datetime.timezone.utc)
+  certBuilder = x509.CertificateBuilder().subject_name(
+    csr.subject
+  ).issuer_name(
+    issuerName
+  ).public_key(
+    csr.public_key()
+  ).serial_number(
+    int(certData['serialNum'])
+  ).not_valid_before(
+    notBefore
+  ).not_valid_after(
+    notBefore + datetime.timedelta(days=int(certData['days']))
+  )
+  for anExtension in certExtensions(caData is None, certData.get('altNames', None)) :
+    certBuilder = certBuilder.add_extension(anExtension, critical=False)
+  theCert = certBuilder.sign(signingKey, signingHash(signingKey))
+
+  writePemFile(certData['certFile'],
+    theCert.public_bytes(serialization.Encoding.PEM), 0o644)
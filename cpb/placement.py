@@ -0,0 +1,296 @@
+# This python module places worker images (and their replicas) on the
+# federation's compute pods, using the capacity of each pod and the
+# demands and constraints of each image.
+#
+# Each compute pod can describe its capacity:
+#
+#   computePods:
+#     - host: nn01
+#       cpus: 64
+#       memory: 128g
+#       arch: x86_64
+#       tags: [ fast, gpu ]
+#
+# (only pods which declare their cpus take part in the placement).
+#
+# Each image (in the cekitImageDescriptions) which should be placed
+# automatically has a placement block:
+#
+#   cekitImageDescriptions:
+#     chef:
+#       placement:
+#         replicas: 8        # the number of replicas in the federation
+#                            # (or `auto` to fill the pods' capacity)
+#         cpus: 2            # the cpus needed by each replica
+#         memory: 4g         # the memory needed by each replica
+#         arch: x86_64       # (or a list) the pods' arch must be one of these
+#         tags: [ fast ]     # the pods must have all of these tags
+#         strategy: spread   # spread the replicas across the pods (or pack
+#                            # them onto as few pods as possible)
+#         maxPerPod: 4       # at most this many replicas on any one pod
+#         affinity: [ cpmd ] # only use pods which run all of these images
+#         antiAffinity: []   # never use pods which run any of these images
+#
+# The placement is a greedy bin packing. The images are placed one at a
+# time (the largest demands first, with images which have an affinity
+# placed after the other images). Each replica is placed on a pod which
+# satisfies the image's constraints and has enough free capacity. The
+# spread strategy chooses the pod with the fewest replicas of the image
+# (and then the most free cpus), the pack strategy chooses the pod with
+# the least free cpus (best fit).
+#
+# Images which are listed explicitly by a pod, and which have a placement
+# block, use (one replica's worth of) that pod's capacity (and that
+# replica is added to any replicas placed on the pod). The number of
+# replicas of every listed or placed image is always recorded in the
+# pod's `imageReplicas`, so that the pod runs exactly the planned number
+# of replicas (whatever the pod's own `replicas` might be).
+#
+# The placed images (and their replica counts) are added to each pod's
+# `images` (and `imageReplicas`), and the plan is recorded in the
+# configuration's `placement` (see the pods command).
+
+import logging
+import sys
+
+placementStrategies = [ 'spread', 'pack' ]
+
+memoryUnits = { 'k' : 1024, 'm' : 1024**2, 'g' : 1024**3, 't' : 1024**4 }
+
+def parseMemory(aMemorySize) :
+  if aMemorySize is None :
+    return None
+  aMemorySize = str(aMemorySize).strip().lower()
+  for aSuffix in [ 'ib', 'i', 'b' ] :
+    if aMemorySize.endswith(aSuffix) :
+      aMemorySize = aMemorySize[:-len(aSuffix)]
+      break
+  multiplier = 1
+  if aMemorySize and aMemorySize[-1] in memoryUnits :
+    multiplier = memoryUnits[aMemorySize[-1]]
+    aMemorySize = aMemorySize[:-1]
+  try :
+    return int(float(aMemorySize) * multiplier)
+  except ValueError :
+    logging.error("Could not understand the memory size [{}]".format(aMemorySize))
+    sys.exit(-1)
+
+def formatMemory(numBytes) :
+  for aUnit in [ 't', 'g', 'm', 'k' ] :
+    if memoryUnits[aUnit] <= numBytes :
+      return "{:.1f}{}".format(numBytes / memoryUnits[aUnit], aUnit)
+  return str(numBytes)
+
+def asList(aValue) :
+  if aValue is None :
+    return []
+  if isinstance(aValue, list) :
+    return aValue
+  return [ aValue ]
+
+def normalizeImagePlacement(anImageName, aPlacement) :
+  if not isinstance(aPlacement, dict) :
+    aPlacement = {}
+  aPlacement = dict(aPlacement)
+  aPlacement.setdefault('replicas', 1)
+  aPlacement['cpus']         = float(aPlacement.get('cpus', 0) or 0)
+  aPlacement['memory']       = parseMemory(aPlacement.get('memory', None)) or 0
+  aPlacement['arch']         = asList(aPlacement.get('arch', None))
+  aPlacement['tags']         = asList(aPlacement.get('tags', None))
+  aPlacement['affinity']     = asList(aPlacement.get('affinity', None))
+  aPlacement['antiAffinity'] = asList(aPlacement.get('antiAffinity', None))
+  aPlacement.setdefault('strategy',  'spread')
+  aPlacement.setdefault('maxPerPod', None)
+  if aPlacement['strategy'] not in placementStrategies :
+    logging.error("Unknown placement strategy [{}] for the {} image (must be one of: {})".format(
+      aPlacement['strategy'], anImageName, ", ".join(placementStrategies)
+    ))
+    sys.exit(-1)
+  replicas = aPlacement['replicas']
+  if replicas == 'auto' :
+    if not aPlacement['cpus'] :
+      logging.error("The {} image MUST declare the cpus of each replica to use auto replicas".format(
+        anImageName
+      ))
+      sys.exit(-1)
+  elif not isinstance(replicas, int) or replicas < 0 :
+    logging.error("The placement replicas of the {} image MUST be a non-negative integer or 'auto' (not [{}])".format(
+      anImageName, replicas
+    ))
+    sys.exit(-1)
+  return aPlacement
+
+def podCapacity(aPod, podDefaults) :
+  cpus = aPod.get('cpus', podDefaults.get('cpus', None))
+  if not cpus :
+    return None
+  return {
+    'podName'    : aPod['host'].split(',')[0],
+    'cpus'       : float(cpus),
+    'memory'     : parseMemory(aPod.get('memory', podDefaults.get('memory', None))),
+    'arch'       : aPod.get('arch', podDefaults.get('arch', None)),
+    'tags'       : set(asList(aPod.get('tags', None)) + asList(podDefaults.get('tags', None))),
+    'usedCpus'   : 0.0,
+    'usedMemory' : 0,
+    'images'     : list(dict.fromkeys(
+      list(aPod.get('images', [])) + list(podDefaults.get('images', []))
+    )),
+    'placed'     : {},
+    'listed'     : set(),
+  }
+
+def useCapacity(aCapacity, aPlacement) :
+  aCapacity['usedCpus']   += aPlacement['cpus']
+  aCapacity['usedMemory'] += aPlacement['memory']
+
+def canPlace(aCapacity, anImageName, aPlacement) :
+  if aPlacement['arch'] and aCapacity['arch'] not in aPlacement['arch'] :
+    return False
+  if not set(aPlacement['tags']).issubset(aCapacity['tags']) :
+    return False
+  for anImage in aPlacement['affinity'] :
+    if anImage not in aCapacity['images'] : return False
+  for anImage in aPlacement['antiAffinity'] :
+    if anImage in aCapacity['images'] : return False
+  maxPerPod = aPlacement['maxPerPod']
+  if maxPerPod is not None and maxPerPod <= aCapacity['placed'].get(anImageName, 0) :
+    return False
+  if aCapacity['cpus'] < aCapacity['usedCpus'] + aPlacement['cpus'] :
+    return False
+  if aCapacity['memory'] is not None \
+    and aCapacity['memory'] < aCapacity['usedMemory'] + aPlacement['memory'] :
+    return False
+  return True
+
+def choosePod(capacities, anImageName, aPlacement) :
+  candidates = [
+    aCapacity for aCapacity in capacities
+      if canPlace(aCapacity, anImageName, aPlacement)
+  ]
+  if not candidates :
+    return None
+  if aPlacement['strategy'] == 'pack' :
+    return min(candidates, key=lambda aCapacity :
+      aCapacity['cpus'] - aCapacity['usedCpus']
+    )
+  return min(candidates, key=lambda aCapacity : (
+    aCapacity['placed'].get(anImageName, 0),
+    aCapacity['usedCpus'] - aCapacity['cpus']
+  ))
+
+def placeImage(capacities, anImageName, aPlacement) :
+  replicas = aPlacement['replicas']
+  numPlaced = 0
+  while replicas == 'auto' or numPlaced < replicas :
+    aCapacity = choosePod(capacities, anImageName, aPlacement)
+    if aCapacity is None :
+      break
+    useCapacity(aCapacity, aPlacement)
+    aCapacity['placed'].setdefault(anImageName, 0)
+    aCapacity['placed'][anImageName] += 1
+    if anImageName not in aCapacity['images'] :
+      aCapacity['images'].append(anImageName)
+    numPlaced += 1
+  if replicas != 'auto' and numPlaced < replicas :
+    logging.error("Could only place {} of the {} replicas of the {} image (the pods do not have enough capacity)".format(
+      numPlaced, replicas, anImageName
+    ))
+    sys.exit(-1)
+  if replicas == 'auto' and numPlaced < 1 :
+    logging.error("Could not place any replicas of the {} image (no pod has enough capacity)".format(
+      anImageName
+    ))
+    sys.exit(-1)
+
+# Place the images and fill in the `images` and `imageReplicas` of each
+# pod (this MUST be done before the pods are normalized).
+#
+def placeImages(config) :
+  imageDescs = config['cpf'].get('cekitImageDescriptions', None) or {}
+  placements = {}
+  for anImageName, anImageDesc in imageDescs.items() :
+    if anImageName == 'defaults' or not isinstance(anImageDesc, dict) : continue
+    if 'placement' not in anImageDesc : continue
+    placements[anImageName] = normalizeImagePlacement(
+      anImageName, anImageDesc['placement']
+    )
+  config['placement'] = {}
+  if not placements :
+    return
+
+  podDefaults = config['cpf']['podDefaults']
+  capacities  = []
+  podsByName  = {}
+  for aPod in config['cpf']['computePods'] :
+    aCapacity = podCapacity(aPod, podDefaults)
+    if aCapacity is None : continue
+    for anImage in aCapacity['images'] :
+      if anImage in placements :
+        useCapacity(aCapacity, placements[anImage])
+        aCapacity['listed'].add(anImage)
+    capacities.append(aCapacity)
+    podsByName[aCapacity['podName']] = aPod
+
+  if not capacities :
+    logging.error("No compute pods declare their cpus, so the images can not be placed")
+    sys.exit(-1)
+
+  placementOrder = sorted(placements.keys(), key=lambda anImageName : (
+    1 if placements[anImageName]['affinity'] else 0,
+    -placements[anImageName]['cpus'],
+    -placements[anImageName]['memory'],
+    anImageName
+  ))
+  for anImageName in placementOrder :
+    placeImage(capacities, anImageName, placements[anImageName])
+
+  for aCapacity in capacities :
+    aPod = podsByName[aCapacity['podName']]
+    replicas = {}
+    for anImageName in aCapacity['images'] :
+      numReplicas = aCapacity['placed'].get(anImageName, 0)
+      if anImageName in aCapacity['listed'] :
+        numReplicas += 1
+      if numReplicas :
+        replicas[anImageName] = numReplicas
+    if replicas :
+      aPod.setdefault('images', [])
+      aPod.setdefault('imageReplicas', {})
+      for anImageName, numReplicas in replicas.items() :
+        if anImageName not in aPod['images'] :
+          aPod['images'].append(anImageName)
+        aPod['imageReplicas'][anImageName] = numReplicas
+    config['placement'][aCapacity['podName']] = {
+      'cpus'       : aCapacity['cpus'],
+      'usedCpus'   : aCapacity['usedCpus'],
+      'memory'     : aCapacity['memory'],
+      'usedMemory' : aCapacity['usedMemory'],
+      'replicas'   : replicas,
+    }
+
+def percentage(used, capacity) :
+  if not capacity :
+    return 0
+  return 100.0 * used / capacity
+
+def printPlacement(config) :
+  if not config.get('placement', None) :
+    return
+  print("\nplacement plan:")
+  print("  {:24} {:>16} {:>20}  {}".format('pod', 'cpus', 'memory', 'images (replicas)'))
+  for aPodName, aPlan in config['placement'].items() :
+    cpuUse = "{:g}/{:g} ({:.0f}%)".format(
+      aPlan['usedCpus'], aPlan['cpus'],
+      percentage(aPlan['usedCpus'], aPlan['cpus'])
+    )
+    memoryUse = "{}/-".format(formatMemory(aPlan['usedMemory']))
+    if aPlan['memory'] is not None :
+      memoryUse = "{}/{} ({:.0f}%)".format(
+        formatMemory(aPlan['usedMemory']), formatMemory(aPlan['memory']),
+        percentage(aPlan['usedMemory'], aPlan['memory'])
+      )
+    replicas = ", ".join(
+      "{} x{}".format(anImageName, numReplicas)
+        for anImageName, numReplicas in aPlan['replicas'].items()
+    )
+    print("  {:24} {:>16} {:>20}  {}".format(aPodName, cpuUse, memoryUse, replicas))
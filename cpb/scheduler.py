@@ -0,0 +1,89 @@
+# This python module provides a simple dependency (DAG) scheduler used to
+# run independent pieces of work (image builds, preBuild scripts, ...) at
+# the same time, while still honouring any dependencies between them, as
+# well as a bounded (streaming) way to run many independent tasks.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import logging
+import sys
+
+def findCycle(pending, parents) :
+  # Walk the parent links of the pending nodes until we revisit a node
+  # (there MUST be a cycle since none of the pending nodes are ready)
+  #
+  aNode = pending[0]
+  visited = []
+  while aNode not in visited :
+    visited.append(aNode)
+    aNode = [ aParent for aParent in parents[aNode] if aParent in pending ][0]
+  return visited[visited.index(aNode):] + [ aNode ]
+
+# Run `runNode(aNode)` for each of the `nodes` using at most `maxWorkers`
+# threads. A node is only started once all of its `parents` have
+# successfully finished. Parents which are not in `nodes` are ignored.
+#
+# The `runNode` function must return True on success. Once any node
+# fails, no further nodes are started, but any running nodes are allowed
+# to finish.
+#
+# Returns the lists of the succeeded, failed and not run nodes.
+#
+def runDag(nodes, parents, runNode, maxWorkers=1) :
+  parents = {
+    aNode : [ aParent for aParent in parents.get(aNode, []) if aParent in nodes ]
+    for aNode in nodes
+  }
+  pending   = list(nodes)
+  running   = {}
+  succeeded = []
+  failed    = []
+
+  with ThreadPoolExecutor(max_workers=max(1, maxWorkers)) as executor :
+    while pending or running :
+      if not failed :
+        readyNodes = [ aNode for aNode in pending
+          if all(aParent in succeeded for aParent in parents[aNode]) ]
+        for aNode in readyNodes :
+          if len(running) >= maxWorkers : break
+          pending.remove(aNode)
+          running[executor.submit(runNode, aNode)] = aNode
+
+      if not running :
+        if pending and not failed :
+          logging.error("Dependency cycle found: {}".format(
+            " -> ".join(findCycle(pending, parents))
+          ))
+          sys.exit(-1)
+        break
+
+      done, notDone = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+      for aFuture in done :
+        aNode = running.pop(aFuture)
+        try :
+          if aFuture.result() :
+            succeeded.append(aNode)
+          else :
+            failed.append(aNode)
+        except Exception as err :
+          logging.error("{} failed: {}".format(aNode, repr(err)))
+          failed.append(aNode)
+
+  return succeeded, failed, pending
+
+# Run `runTask(*aTask)` (using the `executor`) for each of the (possibly
+# generated) `tasks`, yielding each task together with its result in the
+# order of the tasks. At most `maxInFlight` tasks are submitted (or
+# waiting to be reported) at any one time, so that the tasks (and their
+# results) are streamed rather than all held in memory.
+#
+def runInOrder(executor, runTask, tasks, maxInFlight) :
+  inFlight = deque()
+  for aTask in tasks :
+    inFlight.append((aTask, executor.submit(runTask, *aTask)))
+    if len(inFlight) >= max(1, maxInFlight) :
+      aTask, aFuture = inFlight.popleft()
+      yield aTask, aFuture.result()
+  while inFlight :
+    aTask, aFuture = inFlight.popleft()
+    yield aTask, aFuture.result()
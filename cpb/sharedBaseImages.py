@@ -0,0 +1,136 @@
+# This python module factors the common (leading) modules of the images
+# to be built out into shared intermediate base images.
+#
+# Images which are based on the same image, use the same packages
+# manager and the same cekit module repositories are grouped together. A
+# trie of the module lists of each group is built. Wherever (at least
+# `minImages` of) the images share a common prefix of their module list,
+# and then diverge, the prefix is built (once) as an intermediate base
+# image, and the images are rebased onto it (installing only their
+# remaining modules). Nested prefixes give nested intermediate images.
+#
+# If an image's module list is exactly a shared prefix, that image is
+# used as the intermediate base image (rather than generating a new one).
+#
+# This is enabled (in the cpf.yaml) using:
+#
+#   sharedBaseImages: true
+#
+# or (to only share prefixes used by at least 3 images):
+#
+#   sharedBaseImages:
+#     minImages: 3
+#
+# The generated intermediate images are marked `intermediate` and are
+# never pushed to the registry (their layers are pushed as part of the
+# images based upon them).
+
+import hashlib
+import logging
+
+def sharedBaseOptions(cpf) :
+  options = cpf.get('sharedBaseImages', False)
+  if not options :
+    return None
+  if not isinstance(options, dict) :
+    options = {}
+  options.setdefault('minImages', 2)
+  return options
+
+def imageGroupKey(anImageDesc) :
+  return (
+    anImageDesc['basedOn'],
+    anImageDesc['packagesManager'],
+    tuple(anImageDesc['repositories'])
+  )
+
+def newTrieNode() :
+  return { 'children' : {}, 'images' : [], 'ends' : [] }
+
+def buildModuleTrie(imageKeys, imageDescs) :
+  trie = newTrieNode()
+  for anImageKey in imageKeys :
+    aNode = trie
+    for aModule in imageDescs[anImageKey]['modules'] :
+      aNode = aNode['children'].setdefault(aModule, newTrieNode())
+      aNode['images'].append(anImageKey)
+    aNode['ends'].append(anImageKey)
+  return trie
+
+def intermediateImageDesc(config, groupKey, prefix, baseDesc, basedOn, someModules) :
+  aHash = hashlib.sha256(repr((groupKey, prefix)).encode()).hexdigest()[:8]
+  anImageKey = 'shared-{}'.format(aHash)
+  return anImageKey, {
+    'name'            : anImageKey,
+    'imageName'       : "{}-{}".format(config['federationName'], anImageKey),
+    'description'     : "A shared base image (installing: {})".format(", ".join(prefix)),
+    'version'         : '1.0',
+    'basedOn'         : basedOn,
+    'buildBasedOn'    : baseDesc['buildBasedOn'],
+    'packagesManager' : baseDesc['packagesManager'],
+    'repositories'    : list(baseDesc['repositories']),
+    'curDir'          : baseDesc['curDir'],
+    'modules'         : list(someModules),
+    'intermediate'    : True,
+  }
+
+# Walk the trie (depth first) choosing the intermediate base images, and
+# (re)basing each image on the closest intermediate image above it.
+#
+def rebaseImages(config, imageDescs, groupKey, aNode, prefix, base, minImages, newImages) :
+  basedOn, baseLen = base
+  for aModule, aChild in aNode['children'].items() :
+    childPrefix = prefix + [ aModule ]
+    childBase = base
+    continuing = [ anImageKey for anImageKey in aChild['images']
+      if anImageKey not in aChild['ends'] ]
+    isSplit = aChild['ends'] or 1 < len(aChild['children'])
+    if isSplit and minImages <= len(continuing) :
+      if aChild['ends'] :
+        # use an existing image (which installs exactly this prefix)
+        anImageKey = aChild['ends'][0]
+      else :
+        anImageKey, anImageDesc = intermediateImageDesc(
+          config, groupKey, childPrefix, imageDescs[continuing[0]],
+          basedOn, childPrefix[baseLen:]
+        )
+        imageDescs[anImageKey] = anImageDesc
+        newImages.append(anImageKey)
+        logging.info("using the shared base image {} for {}".format(
+          anImageKey, ", ".join(continuing)
+        ))
+      childBase = (imageDescs[anImageKey]['imageName'], len(childPrefix))
+
+    # rebase the images which end here (on the base above this node)
+    for anImageKey in aChild['ends'] :
+      if baseLen :
+        imageDescs[anImageKey]['basedOn'] = basedOn
+        imageDescs[anImageKey]['modules'] = childPrefix[baseLen:]
+
+    rebaseImages(config, imageDescs, groupKey, aChild, childPrefix,
+      childBase, minImages, newImages)
+
+# Returns the keys of any (new) intermediate images (which must be built
+# before the images based upon them).
+#
+def addSharedBaseImages(config, imageKeys, imageDescs) :
+  options = sharedBaseOptions(config['cpf'])
+  if options is None :
+    return []
+
+  groups = {}
+  for anImageKey in imageKeys :
+    if anImageKey not in imageDescs : continue
+    if not imageDescs[anImageKey]['modules'] : continue
+    aGroupKey = imageGroupKey(imageDescs[anImageKey])
+    groups.setdefault(aGroupKey, [])
+    if anImageKey not in groups[aGroupKey] :
+      groups[aGroupKey].append(anImageKey)
+
+  newImages = []
+  for aGroupKey, groupImageKeys in groups.items() :
+    if len(groupImageKeys) < options['minImages'] : continue
+    trie = buildModuleTrie(groupImageKeys, imageDescs)
+    rebaseImages(config, imageDescs, aGroupKey, trie, [],
+      (aGroupKey[0], 0), options['minImages'], newImages)
+  return newImages
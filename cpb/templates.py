@@ -0,0 +1,48 @@
+# This python module provides the (shared) Jinja2 environment used to
+# render all of the cpb templates.
+#
+# Templates are loaded by name from either the cpb.resources package
+# (using the 'resources/' prefix) or the cpb.cekitModules package (using
+# the 'cekitModules/' prefix). Each template is compiled once per process,
+# and the compiled templates are cached on disk (in the `jinja2Cache`
+# directory of the `buildBaseDir`) so that they are only compiled once
+# per machine.
+#
+# Setting the `strictTemplates` configuration option to True, will cause
+# the rendering of any template which uses an undefined value to fail.
+
+import jinja2
+import logging
+import os
+
+templateEnvironment = None
+
+def getEnvironment(config) :
+  global templateEnvironment
+  if templateEnvironment is None :
+    bytecodeCache = None
+    cacheDir = os.path.join(
+      os.path.abspath(os.path.expanduser(config['buildBaseDir'])), 'jinja2Cache'
+    )
+    try :
+      os.makedirs(cacheDir, exist_ok=True)
+      bytecodeCache = jinja2.FileSystemBytecodeCache(cacheDir)
+    except OSError as err :
+      logging.info("Could not create the template cache [{}]: {}".format(cacheDir, repr(err)))
+
+    undefined = jinja2.Undefined
+    if config.get('strictTemplates', False) :
+      undefined = jinja2.StrictUndefined
+
+    templateEnvironment = jinja2.Environment(
+      loader=jinja2.PrefixLoader({
+        'resources'    : jinja2.PackageLoader('cpb', 'resources'),
+        'cekitModules' : jinja2.PackageLoader('cpb', 'cekitModules'),
+      }),
+      bytecode_cache=bytecodeCache,
+      undefined=undefined
+    )
+  return templateEnvironment
+
+def render(config, templateName, templateValues) :
+  return getEnvironment(config).get_template(templateName).render(templateValues)
@@ -0,0 +1,132 @@
+# This python module provides the (optional) instrumentation used to
+# find where the build and create subcommands spend their time.
+#
+# When tracing is enabled, each phase (loading the configuration, staging
+# the cekit modules, running preBuild scripts, building or pushing an
+# image, creating an entity, ...) and each subprocess is recorded (as a
+# Chrome trace-event "complete" event) together with the image or entity
+# name and (for subprocesses) the exit code.
+#
+# The recorded events can be written as a Chrome trace-event file (see
+# chrome://tracing or https://ui.perfetto.dev ), or summarized as a table
+# of timings.
+#
+# Events recorded in worker processes are collected (using `takeEvents`)
+# and returned to the parent process (which uses `addEvents`).
+
+import click
+import contextlib
+import json
+import os
+import threading
+import time
+
+tracingEnabled = False
+traceEvents    = []
+traceLock      = threading.Lock()
+
+def enableTracing(enabled=True) :
+  global tracingEnabled
+  tracingEnabled = enabled
+
+def addEvents(someEvents) :
+  with traceLock :
+    traceEvents.extend(someEvents)
+
+def takeEvents() :
+  with traceLock :
+    someEvents = list(traceEvents)
+    traceEvents.clear()
+  return someEvents
+
+def recordEvent(eventName, category, startTime, endTime, eventArgs) :
+  addEvents([{
+    'name' : eventName,
+    'cat'  : category,
+    'ph'   : 'X',
+    'ts'   : int(startTime * 1000000),
+    'dur'  : int((endTime - startTime) * 1000000),
+    'pid'  : os.getpid(),
+    'tid'  : threading.get_native_id(),
+    'args' : eventArgs,
+  }])
+
+# Record the time taken by the body of the `with` statement. The
+# (yielded) `eventArgs` dict can be used to add details (for example an
+# exit code) to the event.
+#
+@contextlib.contextmanager
+def phase(eventName, category='phase', **eventArgs) :
+  if not tracingEnabled :
+    yield eventArgs
+    return
+  startTime = time.time()
+  try :
+    yield eventArgs
+  finally :
+    recordEvent(eventName, category, startTime, time.time(), eventArgs)
+
+# Record a subprocess (the event is named after the command's program)
+#
+def subprocessPhase(cmd, cwd=None) :
+  eventArgs = { 'cmd' : str(cmd) }
+  if cwd is not None :
+    eventArgs['cwd'] = str(cwd)
+  programName = os.path.basename(str(cmd).split()[0]) if str(cmd).split() else str(cmd)
+  return phase(programName, 'subprocess', **eventArgs)
+
+def writeTrace(tracePath) :
+  with open(tracePath, 'w') as traceFile :
+    json.dump({
+      'traceEvents'     : sorted(traceEvents, key=lambda anEvent : anEvent['ts']),
+      'displayTimeUnit' : 'ms',
+    }, traceFile)
+  click.echo("\nWrote the trace ({} events) to: {}".format(len(traceEvents), tracePath))
+
+def printTimings() :
+  timings = {}
+  for anEvent in traceEvents :
+    aKey = (anEvent['cat'], anEvent['name'])
+    aTiming = timings.setdefault(aKey, {
+      'count' : 0, 'total' : 0, 'max' : 0, 'failed' : 0
+    })
+    aTiming['count'] += 1
+    aTiming['total'] += anEvent['dur']
+    aTiming['max']    = max(aTiming['max'], anEvent['dur'])
+    if anEvent['args'].get('exitCode', 0) != 0 :
+      aTiming['failed'] += 1
+
+  click.echo("\n{:10} {:24} {:>6} {:>10} {:>10} {:>10} {:>6}".format(
+    'category', 'name', 'count', 'total(s)', 'mean(s)', 'max(s)', 'failed'
+  ))
+  click.echo("-"*82)
+  for (category, eventName), aTiming in sorted(
+    timings.items(), key=lambda anItem : anItem[1]['total'], reverse=True
+  ) :
+    click.echo("{:10} {:24} {:>6} {:>10.3f} {:>10.3f} {:>10.3f} {:>6}".format(
+      category, eventName[:24], aTiming['count'],
+      aTiming['total'] / 1000000,
+      aTiming['total'] / aTiming['count'] / 1000000,
+      aTiming['max'] / 1000000,
+      aTiming['failed']
+    ))
+  click.echo("")
+
+# Enable tracing (if either `--trace` or `--timings` has been requested)
+# and then report the results once the subcommand has finished (even if
+# it has exited early).
+#
+@contextlib.contextmanager
+def tracing(tracePath, timings) :
+  if not tracePath and not timings :
+    yield
+    return
+  enableTracing()
+  try :
+    with phase('total') :
+      yield
+  finally :
+    if tracePath :
+      writeTrace(tracePath)
+    if timings :
+      printTimings()
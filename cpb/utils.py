@@ -1,6 +1,21 @@
 # This python module provides utility functions for the cpb commands
 
+import fnmatch
 import os
+import subprocess
+import yaml
+
+import cpb.trace
+
+# Use the (much faster) libyaml based loader when it is available
+#
+try :
+  from yaml import CSafeLoader as YamlSafeLoader
+except ImportError :
+  from yaml import SafeLoader as YamlSafeLoader
+
+def yamlLoad(aStream) :
+  return yaml.load(aStream, Loader=YamlSafeLoader)
 
 def getRegistryFlagAndPath(imageName, registry) :
   registryFlag = "--tls-verify=false"
@@ -19,6 +34,35 @@ def getRegistryFlagAndPath(imageName, registry) :
   registryPath += '/{}'.format(imageName)
   return registryFlag, registryPath.lower()
 
+# Run a shell command (optionally in the `cwd` directory) sending its
+# output to the (optional) `logFile`. Returns the command's exit code.
+#
+def runCommand(cmd, cwd=None, logFile=None) :
+  with cpb.trace.subprocessPhase(cmd, cwd) as traceArgs :
+    result = subprocess.run(cmd, shell=True, cwd=cwd,
+      stdout=logFile, stderr=(subprocess.STDOUT if logFile else None))
+    traceArgs['exitCode'] = result.returncode
+  return result.returncode
+
+# Run a shell command returning its exit code and its (stripped)
+# standard output.
+#
+def captureCommand(cmd, cwd=None) :
+  with cpb.trace.subprocessPhase(cmd, cwd) as traceArgs :
+    result = subprocess.run(cmd, shell=True, cwd=cwd,
+      stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    traceArgs['exitCode'] = result.returncode
+  return result.returncode, result.stdout.strip()
+
+# Does any of the `someNames` match any of the (fnmatch style glob)
+# `selectors`?
+#
+def matchesSelectors(someNames, selectors) :
+  return any(
+    fnmatch.fnmatchcase(aName, aSelector)
+      for aName in someNames if aName for aSelector in selectors
+  )
+
 def sanitizeFilePath(config, filePathKey, pathPrefix) :
   if config[filePathKey][0] == "~" :
     config[filePathKey] = os.path.abspath(
@@ -64,15 +108,22 @@ def mergeDictDefaults(eData, key, value) :
   eData[key] = newDict
 
 def mergePodDefaults(eData, podDefaults) :
-  appendListDefaults(eData, 'hosts',         podDefaults)
-  mergeDictDefaults( eData, 'ports',         podDefaults)
-  appendListDefaults(eData, 'volumes',       podDefaults)
-  mergeDictDefaults( eData, 'envs',          podDefaults)
-  appendListDefaults(eData, 'secrets',       podDefaults)
-  setDefault(        eData, 'maxLoadPerCPU', podDefaults['maxLoadPerCPU'])
-  appendListDefaults(eData, 'images',        podDefaults)
-  appendListDefaults(eData, 'baseImages',    podDefaults)
-  setDefault(        eData, 'shell',         podDefaults['shell'])
+  appendListDefaults(eData, 'hosts',          podDefaults)
+  mergeDictDefaults( eData, 'ports',          podDefaults)
+  appendListDefaults(eData, 'volumes',        podDefaults)
+  mergeDictDefaults( eData, 'envs',           podDefaults)
+  appendListDefaults(eData, 'secrets',        podDefaults)
+  setDefault(        eData, 'maxLoadPerCPU',  podDefaults['maxLoadPerCPU'])
+  setDefault(        eData, 'cpus',           podDefaults['cpus'])
+  setDefault(        eData, 'replicas',       podDefaults['replicas'])
+  mergeDictDefaults( eData, 'imageReplicas',  podDefaults)
+  mergeDictDefaults( eData, 'resources',      podDefaults)
+  mergeDictDefaults( eData, 'imageResources', podDefaults)
+  setDefault(        eData, 'topology',       podDefaults['topology'])
+  appendListDefaults(eData, 'images',         podDefaults)
+  appendListDefaults(eData, 'baseImages',     podDefaults)
+  setDefault(        eData, 'shell',          podDefaults['shell'])
+  setDefault(        eData, 'kubePlay',       podDefaults['kubePlay'])
 
 def mergeCekitImageDescriptions(iData, imageDefaults) :
   setDefault(      iData, 'curDir', os.path.abspath(os.getcwd()))